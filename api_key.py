@@ -11,6 +11,9 @@ bot_name = os.getenv("BOT_NAME")
 assert bot_token, "Missing BOT_TOKEN environment variable"
 assert bot_name, "Missing BOT_NAME environment variable"
 
+# a local Bot API server, e.g. the fake one of the benchmark
+telegram_api_server = os.getenv("TELEGRAM_API_SERVER")
+
 if openai.api_type == "azure": # "OPENAI_API_TYPE"
     engine = "gpt-4"
     DEFAULT_MODEL = None
@@ -0,0 +1,266 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+import openai
+
+from api_key import engine
+from metrics import BACKEND_REQUESTS, HEDGES, RETRIES
+from openai_scheduler import scheduler, is_retryable, INTERACTIVE, MAX_RETRIES, BACKOFF_BASE, BACKOFF_MAX
+
+# Backend pool
+#
+# The OpenAI and Azure deployments the requests can go to, configured as a JSON list in OPENAI_BACKENDS:
+#
+#   [{"name": "openai", "api_key": "sk-..."},
+#    {"name": "azure-eu", "api_type": "azure", "api_base": "https://eu.openai.azure.com", "api_key": "...",
+#     "api_version": "2023-05-15", "deployments": {"gpt-3.5-turbo": "chat", "whisper-1": "whisper"}}]
+#
+# Without it the pool holds one backend configured like the openai module.
+# A request goes to the backend with the lowest expected latency, penalized by its recent errors and by the
+# time its rate window needs to admit the request. A transient failure (429, 5xx, connection) fails over to
+# the next backend right away. Streamed interactive requests are hedged: if the first backend takes longer
+# than usual to start answering, the request is sent to the second one too and the first answer wins.
+# Latency is tracked per model and per kind of request, the time to the first byte of a stream has little to
+# do with the time a whole completion takes.
+
+OPENAI_BACKENDS = os.getenv("OPENAI_BACKENDS")
+# a hedge is sent after HEDGE_FACTOR times the backend's usual latency, within these bounds
+HEDGE_FACTOR = 2.0
+HEDGE_MIN = float(os.getenv("HEDGE_MIN", 1.0))  # seconds
+HEDGE_MAX = float(os.getenv("HEDGE_MAX", 10.0))  # seconds
+# assumed latency of a backend without observations
+DEFAULT_LATENCY = 1.0
+# weight of the latest observation in the moving averages
+EWMA_ALPHA = 0.2
+# an error rate of 1 makes a backend look this many times slower
+ERROR_PENALTY = 5
+
+
+class Backend():
+    """
+    One endpoint with its credentials, and its observed latency and error rate.
+    """
+
+    def __init__(self, name: str, api_type: str = None, api_base: str = None, api_key: str = None,
+                 api_version: str = None, deployments: dict = None, models: list = None):
+        self.name = name
+        self.api_type = api_type
+        self.api_base = api_base
+        self.api_key = api_key
+        self.api_version = api_version
+        self.deployments = deployments or {}  # model -> azure deployment, "*" for every model
+        self.models = models  # the models an OpenAI backend serves, None for all
+        self.latencies = {}  # request kind -> moving average of the latency
+        self.error_rate = 0.0
+
+    @property
+    def azure(self) -> bool:
+        return (self.api_type or openai.api_type or "").startswith("azure")
+
+    def serves(self, model: str) -> bool:
+        if self.azure:
+            return model in self.deployments or "*" in self.deployments
+        return self.models is None or model in self.models
+
+    def arguments(self, model: str) -> dict:
+        """
+        The arguments of the openai call that send it to this backend.
+        """
+        arguments = {name: value for name, value in (("api_type", self.api_type), ("api_base", self.api_base),
+                                                     ("api_key", self.api_key), ("api_version", self.api_version))
+                     if value is not None}
+        arguments["model"] = model
+        if self.azure:
+            arguments["engine"] = self.deployments.get(model) or self.deployments["*"]
+        return arguments
+
+    def latency(self, kind: str) -> float:
+        return self.latencies.get(kind, DEFAULT_LATENCY)
+
+    def observe(self, kind: str, latency: float = None, failed: bool = False):
+        self.error_rate += EWMA_ALPHA * ((1.0 if failed else 0.0) - self.error_rate)
+        if latency is not None:
+            previous = self.latencies.get(kind)
+            self.latencies[kind] = latency if previous is None else previous + EWMA_ALPHA * (latency - previous)
+
+    def hedge_delay(self, kind: str) -> float:
+        return min(max(self.latency(kind) * HEDGE_FACTOR, HEDGE_MIN), HEDGE_MAX)
+
+    def str(self):
+        latencies = ", ".join(f"{kind} {latency:.2f}s" for kind, latency in sorted(self.latencies.items())) or "-"
+        return f"{self.name}: latency {latencies}, errors {self.error_rate * 100:.0f}%"
+
+
+def request_kind(model: str, kwargs: dict) -> str:
+    return f"{model}/stream" if kwargs.get("stream") else model
+
+
+def load_backends(config: str = OPENAI_BACKENDS, engine: str = None) -> list:
+    if config:
+        return [Backend(**entry) for entry in json.loads(config)]
+    # the openai module settings; on Azure the chat requests name the engine as their model and go to its
+    # deployment, transcription and speech need OPENAI_BACKENDS with deployments of their own
+    return [Backend("default", deployments={engine: engine} if engine else None)]
+
+
+class BackendPool():
+    """
+    Routes the OpenAI calls over the backends, through the request scheduler.
+    """
+
+    def __init__(self, backends: list, max_retries: int = MAX_RETRIES):
+        self.backends = backends
+        self.max_retries = max_retries
+
+    def rank(self, model: str, tokens: int, kind: str = None) -> list:
+        """
+        :return: the backends serving the model, the one expected to answer first first.
+        """
+        now = time.monotonic()
+        kind = kind or model
+
+        def cost(backend: Backend) -> float:
+            wait = scheduler.window(f"{backend.name}/{model}").wait_time(tokens, now)
+            return backend.latency(kind) * (1 + ERROR_PENALTY * backend.error_rate) + wait
+
+        return sorted((backend for backend in self.backends if backend.serves(model)), key=cost)
+
+    async def _attempt(self, backend: Backend, fn, args, model: str, priority: int, tokens: int, kwargs: dict,
+                       on_sent=None, reserve: int = 0):
+        kind = request_kind(model, kwargs)
+
+        async def timed(*args, **kwargs):
+            # the scheduler admitted it, the request goes out now
+            if on_sent is not None:
+                on_sent(model)
+            start = time.monotonic()
+            result = await fn(*args, **kwargs)
+            backend.observe(kind, time.monotonic() - start)
+            return result
+
+        try:
+            result = await scheduler.call(timed, *args, priority=priority, tokens=tokens,
+                                          limits=f"{backend.name}/{model}", retries=0, reserve=reserve,
+                                          **backend.arguments(model), **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # a bad request is not the backend's fault
+            if is_retryable(e):
+                backend.observe(kind, failed=True)
+                BACKEND_REQUESTS.inc(backend.name, "error")
+            raise
+        BACKEND_REQUESTS.inc(backend.name, "ok")
+        return result
+
+    async def _hedged(self, first: Backend, second: Backend, fn, args, model: str, priority: int, tokens: int,
+                      kwargs: dict, on_hedge_lost=None, on_sent=None, reserve: int = 0):
+        sent = set()  # the backends the request actually went to
+
+        def attempt(backend: Backend) -> asyncio.Future:
+            def mark(model: str):
+                sent.add(backend)
+                if on_sent is not None:
+                    on_sent(model)
+            return asyncio.ensure_future(self._attempt(backend, fn, args, model, priority, tokens, kwargs, mark,
+                                                       reserve))
+
+        first_task = attempt(first)
+        tasks = {first_task: first}
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=first.hedge_delay(request_kind(model, kwargs)))
+            if done and (first_task.exception() is None or not is_retryable(first_task.exception())):
+                winner = first_task
+                return first_task.result()
+
+            if not done:
+                logging.info(f"{first.name} is slow, hedging the {model} request on {second.name}")
+                HEDGES.inc(model)
+            # a quick transient failure goes straight to the second backend
+            tasks[attempt(second)] = second
+
+            error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task, backend in tasks.items():
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                    # still waiting in the scheduler, it cost nothing
+                    if backend not in sent:
+                        continue
+                    BACKEND_REQUESTS.inc(backend.name, "hedge_lost")
+                elif task.cancelled() or task.exception() is not None:
+                    continue
+                else:
+                    # both answered at once, a stream nobody reads still holds a connection
+                    result = task.result()
+                    if hasattr(result, "aclose"):
+                        asyncio.ensure_future(result.aclose())
+                # the loser was sent, so it is billed; a completion reports its usage, a stream doesn't
+                if winner is not None and on_hedge_lost is not None:
+                    usage = task.result().get("usage") if task.done() and isinstance(task.result(), dict) else None
+                    on_hedge_lost(model, usage)
+
+    async def call(self, fn, *args, model: str, priority: int = INTERACTIVE, tokens: int = 0, hedge: bool = False,
+                   on_hedge_lost=None, on_sent=None, reserve: int = 0, **kwargs):
+        """
+        Runs `fn(*args, model=..., **kwargs)` on the best backend serving the model, failing over on transient errors.
+        The credentials of the backend are passed as api_key, api_base, api_type, api_version and engine.
+
+        :param model: the model the request is for.
+        :param hedge: repeat the request on the second best backend if the first one is slow to answer.
+        :param on_hedge_lost: called with (model, usage) for every hedged request that lost, usage is None when
+                              the response doesn't tell it, so the spend can be recorded.
+        :param on_sent: called with the model every time the request is actually sent to a backend, a caller
+                        cancelled afterwards is billed for it.
+        :param reserve: the part of `tokens` reserved for the completion, see RequestScheduler.call.
+        """
+        for attempt in range(self.max_retries + 1):
+            backends = self.rank(model, tokens, request_kind(model, kwargs))
+            if not backends:
+                raise Exception(f"No backend serves {model}")
+
+            index = 0
+            while index < len(backends):
+                try:
+                    if hedge and index + 1 < len(backends):
+                        return await self._hedged(backends[index], backends[index + 1], fn, args, model, priority,
+                                                  tokens, kwargs, on_hedge_lost, on_sent, reserve)
+                    return await self._attempt(backends[index], fn, args, model, priority, tokens, kwargs, on_sent,
+                                               reserve)
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    error = e
+                    logging.warning(f"{model} request failed on {backends[index].name} ({e}), failing over")
+                index += 2 if hedge and index + 1 < len(backends) else 1
+
+            if attempt == self.max_retries:
+                raise error
+
+            # every backend failed, the ones that asked for it are paused in the scheduler
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            logging.warning(f"{model} request failed on all backends, retry {attempt + 1} in {delay:.1f}s")
+            RETRIES.inc(model)
+            await asyncio.sleep(delay)
+
+    def str(self):
+        return ", ".join(backend.str() for backend in self.backends)
+
+
+pool = BackendPool(load_backends(engine=engine))
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# Local stand-ins for the Telegram Bot API, the OpenAI chat/audio endpoints and the reader service.
+# All of them are served by one aiohttp application, with configurable latency and error injection.
+
+ANSWER = ("Sure, here is a short answer to your question. It is long enough to be streamed in several chunks "
+          "and to exercise the message edits of the bot.")
+TRANSCRIPT = "please summarize the last messages of this chat"
+ARTICLE = "A fetched article. " * 200
+VOICE_BYTES = b"OggS" + bytes(16 * 1024)
+
+
+class FakeConfig():
+    def __init__(self, telegram_latency: float = 0.02, openai_latency: float = 0.5, token_interval: float = 0.02,
+                 transcribe_latency: float = 1.0, fetch_latency: float = 0.3, error_rate: float = 0.0,
+                 answer: str = ANSWER):
+        self.telegram_latency = telegram_latency
+        self.openai_latency = openai_latency  # time to the first token
+        self.token_interval = token_interval  # time between streamed tokens
+        self.transcribe_latency = transcribe_latency
+        self.fetch_latency = fetch_latency
+        self.error_rate = error_rate  # share of the requests answered with 429/500
+        self.answer = answer
+
+
+class FakeServers():
+    """
+    Serves the fake APIs on http://host:port.
+    `listener(chat_id, method, params)` is called for every message the bot sends or edits.
+    """
+
+    def __init__(self, config: FakeConfig, bot_name: str, listener=None):
+        self.config = config
+        self.bot_name = bot_name
+        self.listener = listener
+        self.calls = Counter()
+        self.errors = Counter()
+        self.message_ids = 0
+        self.runner = None
+        self.url = None
+
+    def _fail(self) -> bool:
+        return self.config.error_rate and random.random() < self.config.error_rate
+
+    # Telegram
+
+    def _message(self, chat_id, text: str, message_id: int = None):
+        if message_id is None:
+            self.message_ids += 1
+            message_id = self.message_ids
+        chat_type = "private" if int(chat_id) > 0 else "group"
+        return {"message_id": message_id, "date": int(time.time()), "text": text,
+                "chat": {"id": int(chat_id), "type": chat_type},
+                "from": {"id": 1, "is_bot": True, "first_name": "bench", "username": self.bot_name}}
+
+    async def telegram(self, request: web.Request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls["telegram." + method] += 1
+        await asyncio.sleep(self.config.telegram_latency)
+
+        if method != "getMe" and self._fail():
+            self.errors["telegram." + method] += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": self.bot_name}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, params.get("text", ""), params.get("message_id") and int(params["message_id"]))
+        elif method == "sendVoice":
+            result = self._message(chat_id, "")
+        elif method == "getFile":
+            result = {"file_id": params["file_id"], "file_unique_id": params["file_id"], "file_size": len(VOICE_BYTES),
+                      "file_path": f"voice/{params['file_id']}.oga"}
+        else:
+            result = True
+
+        if self.listener is not None and chat_id is not None and method in ("sendMessage", "editMessageText", "sendVoice"):
+            self.listener(int(chat_id), method, params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def telegram_file(self, request: web.Request):
+        self.calls["telegram.file"] += 1
+        await asyncio.sleep(self.config.telegram_latency)
+        return web.Response(body=VOICE_BYTES, content_type="audio/ogg")
+
+    # OpenAI
+
+    def _openai_error(self, kind: str):
+        self.errors[kind] += 1
+        if random.random() < 0.5:
+            return web.json_response({"error": {"message": "Rate limit reached", "type": "requests"}},
+                                     status=429, headers={"retry-after": "1"})
+        return web.json_response({"error": {"message": "The server had an error", "type": "server_error"}}, status=500)
+
+    async def chat_completions(self, request: web.Request):
+        data = await request.json()
+        self.calls["openai.chat"] += 1
+        if self._fail():
+            return self._openai_error("openai.chat")
+
+        model = data.get("model") or "gpt-3.5-turbo"
+        prompt_tokens = sum(len(m["content"]) // 4 + 4 for m in data["messages"])
+        words = self.config.answer.split(" ")
+        await asyncio.sleep(self.config.openai_latency)
+
+        if not data.get("stream"):
+            choices = [{"index": index, "message": {"role": "assistant", "content": self.config.answer},
+                        "finish_reason": "stop"} for index in range(data.get("n", 1))]
+            completion_tokens = len(words) * len(choices)
+            return web.json_response({"id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+                                      "model": model, "choices": choices,
+                                      "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                                "total_tokens": prompt_tokens + completion_tokens}})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        def chunk(delta: dict, finish_reason=None):
+            payload = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            return f"data: {json.dumps(payload)}\n\n".encode()
+
+        await response.write(chunk({"role": "assistant"}))
+        for index, word in enumerate(words):
+            await response.write(chunk({"content": word if index == 0 else " " + word}))
+            await asyncio.sleep(self.config.token_interval)
+        await response.write(chunk({}, "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def transcriptions(self, request: web.Request):
+        await request.read()
+        self.calls["openai.transcriptions"] += 1
+        if self._fail():
+            return self._openai_error("openai.transcriptions")
+        await asyncio.sleep(self.config.transcribe_latency)
+        return web.json_response({"text": TRANSCRIPT})
+
+    async def speech(self, request: web.Request):
+        await request.json()
+        self.calls["openai.speech"] += 1
+        if self._fail():
+            return self._openai_error("openai.speech")
+        await asyncio.sleep(self.config.transcribe_latency)
+        return web.Response(body=VOICE_BYTES, content_type="audio/ogg")
+
+    # reader
+
+    async def extract(self, request: web.Request):
+        params = await request.post()
+        self.calls["reader.extract"] += 1
+        await asyncio.sleep(self.config.fetch_latency)
+        return web.json_response({"kind": "article", "textContent": ARTICLE, "title": params.get("url"), "byline": None,
+                                  "length": len(ARTICLE), "excerpt": ARTICLE[:100], "siteName": None, "language": "en"})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.telegram_file)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/audio/transcriptions", self.transcriptions)
+        app.router.add_post("/v1/audio/speech", self.speech)
+        app.router.add_post("/api/extract", self.extract)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
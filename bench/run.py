@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_servers import FakeConfig, FakeServers
+
+# Load test of openaitelegram.py
+#
+# Starts the fake Telegram/OpenAI/reader servers, points the bot at them and feeds the real Dispatcher
+# with the updates of thousands of simulated chats. Reports the throughput, the latency from an update
+# to the final answer, the event loop blocking time and the memory growth.
+#
+#   python bench/run.py --chats 2000 --turns 3 --openai-latency 0.5 --error-rate 0.01
+
+BOT_NAME = "benchbot"
+BOT_TOKEN = "123456:BENCH"
+PLACEHOLDER = u"…"
+LAG_INTERVAL = 0.01  # seconds
+LAG_THRESHOLD = 0.05  # seconds, lag above this counts as blocked
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of openaitelegram.py")
+    parser.add_argument("--chats", type=int, default=1000, help="number of simulated chats")
+    parser.add_argument("--turns", type=int, default=3, help="messages sent by every chat")
+    parser.add_argument("--group-ratio", type=float, default=0.3, help="share of group chats")
+    parser.add_argument("--mention-ratio", type=float, default=0.3, help="share of group messages addressed to the bot")
+    parser.add_argument("--voice-ratio", type=float, default=0.1, help="share of voice messages in private chats")
+    parser.add_argument("--url-ratio", type=float, default=0.1, help="share of messages with a link")
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which the chats start")
+    parser.add_argument("--think-time", type=float, default=1, help="max seconds between the turns of a chat")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for an answer")
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--transcribe-latency", type=float, default=1.0)
+    parser.add_argument("--fetch-latency", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--debounce", type=float, default=None, help="override DEBOUNCE_SECONDS")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(q / 100 * len(values)), len(values) - 1)]
+
+
+def configure_environment(url: str, args, store_path: str):
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "BOT_NAME": BOT_NAME,
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_API_BASE": url + "/v1",
+        "TELEGRAM_API_SERVER": url,
+        "READER_URL": url + "/api/extract",
+        "CONVERSATION_STORE": store_path,
+        "METRICS_PORT": "0",
+        # the benchmark measures the bot, not the flood protection
+        "USER_RATE_LIMIT": "0.000001",
+        "USER_BURST": "1000000",
+        "CHAT_RATE_LIMIT": "0.000001",
+        "CHAT_BURST": "1000000",
+        "GLOBAL_RATE": "1000000000",
+        "GLOBAL_BURST": "1000000000",
+        "USAGE_STORE": ":memory:",
+        "USER_DAILY_TOKENS": "0",
+        "USER_MONTHLY_TOKENS": "0",
+        "CHAT_DAILY_TOKENS": "0",
+        "USER_DAILY_VOICE_SECONDS": "0",
+        "SEND_RATE": "1000000",
+        "SEND_BURST": "1000000",
+        # the fake OpenAI server has no rate limits, the windows would only slow the bot down
+        "OPENAI_MODEL_LIMITS": json.dumps({model: [1000000000, 0] for model in (
+            "gpt-3.5-turbo", "gpt-3.5-turbo-16k", "gpt-4", "whisper-1", "tts-1", "*")}),
+    })
+    if args.debounce is not None:
+        os.environ["DEBOUNCE_SECONDS"] = str(args.debounce)
+    check_tokenizer()
+
+
+def check_tokenizer():
+    """
+    Loads the tiktoken encoding before the run. tiktoken downloads it on first use, so on a host without
+    access the bot estimates the tokens for the whole run instead of trying the download during the run.
+    """
+    try:
+        import tiktoken
+        tiktoken.get_encoding("cl100k_base")
+    except ImportError:
+        return
+    except Exception as e:
+        logging.warning(f"No tiktoken encoding ({e}), the bot estimates the tokens")
+        # makes `import tiktoken` fail, so tokens.py takes the estimate
+        sys.modules["tiktoken"] = None
+
+
+class Chat():
+    def __init__(self, chat_id: int, is_group: bool):
+        self.id = chat_id
+        self.is_group = is_group
+        self.users = [random.randint(1, 10 ** 9) for _ in range(5)] if is_group else [chat_id]
+
+
+class Simulation():
+    def __init__(self, args):
+        self.args = args
+        self.update_id = 0
+        self.message_id = 0
+        self.waiting = {}  # chat id -> future resolved by the final answer
+        self.latencies = []
+        self.timeouts = 0
+        self.updates = 0
+        self.lag = []
+
+    def on_bot_message(self, chat_id: int, method: str, params: dict):
+        text = params.get("text", "")
+        if method == "editMessageText":
+            final = bool(params.get("parse_mode"))
+        elif method == "sendMessage":
+            final = text not in (PLACEHOLDER, "Suggestions:") and not text.startswith("_> ")
+        else:
+            final = True
+
+        future = self.waiting.get(chat_id)
+        if final and future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    def make_update(self, chat: Chat):
+        self.update_id += 1
+        self.message_id += 1
+        user_id = random.choice(chat.users)
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat.id, "type": "group", "title": "bench"} if chat.is_group else
+                    {"id": chat.id, "type": "private", "first_name": "user"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user", "username": f"user{user_id}",
+                     "language_code": "en"},
+        }
+
+        addressed = not chat.is_group or random.random() < self.args.mention_ratio
+        if not chat.is_group and random.random() < self.args.voice_ratio:
+            message["voice"] = {"file_id": f"voice{self.message_id}", "file_unique_id": f"voice{self.message_id}",
+                                "duration": random.randint(1, 60)}
+            return {"update_id": self.update_id, "message": message}, addressed
+
+        text = "what do you think about it?"
+        entities = []
+        if addressed and chat.is_group:
+            mention = "@" + BOT_NAME
+            entities.append({"type": "mention", "offset": 0, "length": len(mention)})
+            text = mention + " " + text
+        if random.random() < self.args.url_ratio:
+            url = f"https://example.com/article/{random.randint(1, 50)}"
+            entities.append({"type": "url", "offset": len(text) + 1, "length": len(url)})
+            text = text + " " + url
+
+        message["text"] = text
+        if entities:
+            message["entities"] = entities
+        return {"update_id": self.update_id, "message": message}, addressed
+
+    async def run_chat(self, dp, chat: Chat):
+        from aiogram import types
+
+        await asyncio.sleep(random.uniform(0, self.args.ramp_up))
+        for _ in range(self.args.turns):
+            data, addressed = self.make_update(chat)
+            future = None
+            if addressed:
+                future = self.waiting[chat.id] = asyncio.get_running_loop().create_future()
+
+            start = time.perf_counter()
+            self.updates += 1
+            await dp.process_update(types.Update(**data))
+
+            if future is not None:
+                try:
+                    end = await asyncio.wait_for(future, self.args.timeout)
+                    self.latencies.append(end - start)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                finally:
+                    self.waiting.pop(chat.id, None)
+
+            await asyncio.sleep(random.uniform(0, self.args.think_time))
+
+    async def monitor_lag(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lag.append(max(time.perf_counter() - start - LAG_INTERVAL, 0))
+
+
+async def main(args):
+    random.seed(args.seed)
+    simulation = Simulation(args)
+    config = FakeConfig(telegram_latency=args.telegram_latency, openai_latency=args.openai_latency,
+                        token_interval=args.token_interval, transcribe_latency=args.transcribe_latency,
+                        fetch_latency=args.fetch_latency, error_rate=args.error_rate)
+    servers = FakeServers(config, BOT_NAME, listener=simulation.on_bot_message)
+    url = await servers.start()
+
+    store = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False)
+    configure_environment(url, args, store.name)
+
+    from aiogram import Bot, Dispatcher
+    import openai
+    import openaitelegram
+
+    openai.api_base = url + "/v1"
+    # the bot configures INFO logging on import
+    logging.getLogger().setLevel(logging.WARNING)
+    Bot.set_current(openaitelegram.bot)
+    Dispatcher.set_current(openaitelegram.dp)
+    # the timed flushes of the conversations and the usage run like in production
+    await openaitelegram.on_startup(openaitelegram.dp)
+
+    chats = []
+    for index in range(args.chats):
+        is_group = random.random() < args.group_ratio
+        chats.append(Chat(-(index + 1) if is_group else index + 1, is_group))
+
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    lag_monitor = asyncio.create_task(simulation.monitor_lag())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(simulation.run_chat(openaitelegram.dp, chat) for chat in chats))
+    elapsed = time.perf_counter() - started
+
+    lag_monitor.cancel()
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    await openaitelegram.on_shutdown(openaitelegram.dp)
+    await openaitelegram.bot.close()
+    await servers.stop()
+    os.unlink(store.name)
+
+    latencies = simulation.latencies
+    blocked = [lag for lag in simulation.lag if lag > LAG_THRESHOLD]
+    print(f"chats: {len(chats)} ({sum(chat.is_group for chat in chats)} groups), updates: {simulation.updates}")
+    print(f"elapsed: {elapsed:.1f}s, throughput: {simulation.updates / elapsed:.1f} updates/s, "
+          f"{len(latencies) / elapsed:.1f} answers/s")
+    print(f"answers: {len(latencies)}, timeouts: {simulation.timeouts}")
+    print(f"latency p50: {percentile(latencies, 50):.3f}s, p95: {percentile(latencies, 95):.3f}s, "
+          f"p99: {percentile(latencies, 99):.3f}s, max: {max(latencies, default=float('nan')):.3f}s")
+    print(f"event loop lag max: {max(simulation.lag, default=0) * 1000:.1f}ms, "
+          f"p99: {percentile(simulation.lag, 99) * 1000:.1f}ms, "
+          f"blocked: {sum(blocked):.2f}s in {len(blocked)} stalls > {LAG_THRESHOLD * 1000:.0f}ms")
+    print(f"memory growth: {(memory_after - memory_before) / 2 ** 20:.1f}MB, peak: {memory_peak / 2 ** 20:.1f}MB, "
+          f"max rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB")
+    print("calls: " + ", ".join(f"{name}={count}" for name, count in sorted(servers.calls.items())))
+    if servers.errors:
+        print("injected errors: " + ", ".join(f"{name}={count}" for name, count in sorted(servers.errors.items())))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parse_args()))
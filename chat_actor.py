@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+# messages arriving within this window are answered by a single completion
+DEBOUNCE_SECONDS = float(os.getenv("DEBOUNCE_SECONDS", 0.8))
+
+
+class ChatActor():
+    """
+    Serializes the processing of a single chat.
+    The lock guards the conversation history, `pending` is the scheduled or running answer.
+    """
+    __slots__ = ("lock", "pending", "refs")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = None
+        self.refs = 0
+
+    def cancel(self):
+        """
+        Cancels the pending answer, it is superseded by a newer message.
+        """
+        if self.pending is not None and not self.pending.done():
+            self.pending.cancel()
+        self.pending = None
+
+    async def _run(self, factory, delay: float):
+        await asyncio.sleep(delay)
+        async with self.lock:
+            await factory()
+
+
+class ChatActors():
+    """
+    Keeps a ChatActor for every chat that has messages in flight.
+    Actors are dropped as soon as nothing references them.
+    While a chat has an actor its conversation is pinned in the store.
+    """
+
+    def __init__(self, conversations=None, debounce: float = DEBOUNCE_SECONDS):
+        self.conversations = conversations
+        self.debounce = debounce
+        self.actors = {}
+
+    def acquire(self, chat_id: int) -> ChatActor:
+        actor = self.actors.get(chat_id)
+        if actor is None:
+            actor = self.actors[chat_id] = ChatActor()
+            if self.conversations is not None:
+                self.conversations.pin(chat_id)
+        actor.refs += 1
+        return actor
+
+    def release(self, chat_id: int):
+        actor = self.actors[chat_id]
+        actor.refs -= 1
+        if actor.refs == 0:
+            del self.actors[chat_id]
+            if self.conversations is not None:
+                self.conversations.unpin(chat_id)
+
+    def pending(self) -> list:
+        """
+        Returns the scheduled and running answers.
+        """
+        return [actor.pending for actor in self.actors.values() if actor.pending is not None and not actor.pending.done()]
+
+    def schedule(self, chat_id: int, factory) -> asyncio.Task:
+        """
+        Schedules the answer of the chat after the debounce window, replacing the pending one.
+        The answer runs under the chat lock.
+
+        :param factory: a function returning the coroutine that answers the chat.
+        """
+        actor = self.acquire(chat_id)
+        actor.cancel()
+        actor.pending = asyncio.create_task(actor._run(factory, self.debounce))
+        actor.pending.add_done_callback(lambda task: self.release(chat_id))
+        return actor.pending
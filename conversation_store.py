@@ -0,0 +1,304 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+from user_thread import UserChatThread
+
+STORE_PATH = os.getenv("CONVERSATION_STORE", "conversations.sqlite3")
+# number of conversations kept in memory, the rest lives in the backend
+HOT_CONVERSATIONS = int(os.getenv("HOT_CONVERSATIONS", 1000))
+# changed conversations are saved at least this often, so a crash loses little
+FLUSH_SECONDS = float(os.getenv("CONVERSATION_FLUSH_SECONDS", 10))
+# group messages not addressed to the bot, kept to give the next question its context
+PASSIVE_MESSAGES = int(os.getenv("PASSIVE_MESSAGES", 20))
+PASSIVE_CHARS = 500
+# chats whose group messages are kept, the least recently active are forgotten
+PASSIVE_CHATS = int(os.getenv("PASSIVE_CHATS", 10000))
+
+
+# Backends keep a version with every conversation. A save only succeeds if the row still has the version
+# the conversation was loaded with, so when two processes hold the same chat (e.g. while the webhook workers
+# change) the one with the stale copy loses its write instead of overwriting the newer one.
+
+
+class MemoryBackend():
+    """
+    Keeps the serialized conversations in a dictionary, nothing survives a restart.
+    """
+
+    def __init__(self):
+        self.rows = {}  # chat_id -> (json, version)
+
+    def load(self, chat_id: int):
+        """
+        :return: a tuple (data, version), or None if the chat has no conversation.
+        """
+        row = self.rows.get(chat_id)
+        return (json.loads(row[0]), row[1]) if row is not None else None
+
+    def save_many(self, items):
+        """
+        :param items: tuples (chat_id, data, version it was loaded with, 0 for a new one).
+        :return: a dictionary chat_id -> the new version, or None if the row changed since it was loaded.
+        """
+        versions = {}
+        for chat_id, data, version in items:
+            row = self.rows.get(chat_id)
+            if (row[1] if row is not None else 0) != version:
+                versions[chat_id] = None
+                continue
+            self.rows[chat_id] = (json.dumps(data), version + 1)
+            versions[chat_id] = version + 1
+        return versions
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend():
+    """
+    Keeps the serialized conversations in a SQLite database, one JSON row per chat.
+    """
+
+    def __init__(self, path: str = STORE_PATH):
+        # used from the store's worker thread and, for the rare unannounced load, from the event loop
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS conversations (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, "
+                        "version INTEGER NOT NULL DEFAULT 0)")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(conversations)")]
+        if "version" not in columns:
+            self.db.execute("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self.db.commit()
+
+    def load(self, chat_id: int):
+        with self.lock:
+            row = self.db.execute("SELECT data, version FROM conversations WHERE chat_id = ?", (chat_id,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row is not None else None
+
+    def save_many(self, items):
+        versions = {}
+        with self.lock:
+            for chat_id, data, version in items:
+                if version == 0:
+                    cursor = self.db.execute("INSERT INTO conversations (chat_id, data, version) VALUES (?, ?, 1) "
+                                             "ON CONFLICT (chat_id) DO NOTHING", (chat_id, json.dumps(data)))
+                else:
+                    cursor = self.db.execute("UPDATE conversations SET data = ?, version = version + 1 "
+                                             "WHERE chat_id = ? AND version = ?", (json.dumps(data), chat_id, version))
+                versions[chat_id] = version + 1 if cursor.rowcount == 1 else None
+            self.db.commit()
+        return versions
+
+    def close(self):
+        self.db.close()
+
+
+class ConversationStore():
+    """
+    A dictionary like store of UserChatThread objects.
+    Keeps about `capacity` recently used conversations in memory, the least recently used ones are
+    spilled to the backend and loaded back lazily on first access.
+    A conversation pinned by a handler or a background task stays in memory until it is unpinned, so
+    their changes are not made to a copy that was already spilled.
+    Threads flag their own changes. The changed ones are saved and the excess is spilled by the timed
+    flush, which runs the backend in a worker thread; handlers `load` a conversation off the event loop
+    before they use it.
+    The group messages the bot doesn't answer wait next to the conversations, in memory only, so the chatter
+    of a busy group neither loads nor saves its conversation.
+    """
+
+    def __init__(self, backend=None, capacity: int = HOT_CONVERSATIONS, flush_seconds: float = FLUSH_SECONDS):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.capacity = capacity
+        self.flush_seconds = flush_seconds
+        self.hot = OrderedDict()
+        self.versions = {}  # chat_id -> version of the row the hot conversation was loaded from
+        self.pins = {}      # chat_id -> number of holders
+        self.loading = {}   # chat_id -> future of a load running in the worker thread
+        self.passive = OrderedDict()  # chat_id -> deque of (author, text)
+        # a single thread, so the backend connection is never used concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversations")
+        self.flush_lock = asyncio.Lock()
+        self.flush_now = None
+        self.flusher = None
+
+    def __getitem__(self, chat_id: int) -> UserChatThread:
+        thread = self.hot.get(chat_id)
+        if thread is not None:
+            self.hot.move_to_end(chat_id)
+            return thread
+        # not loaded in advance, e.g. by a background task, read it right here
+        return self._insert(chat_id, self.backend.load(chat_id))
+
+    async def load(self, chat_id: int) -> UserChatThread:
+        """
+        Makes the conversation hot, reading it from the backend in the worker thread.
+        """
+        if chat_id in self.hot:
+            return self[chat_id]
+
+        future = self.loading.get(chat_id)
+        if future is None:
+            future = self.loading[chat_id] = asyncio.get_running_loop().run_in_executor(
+                self.executor, self.backend.load, chat_id)
+            future.add_done_callback(lambda _: self.loading.pop(chat_id, None))
+        row = await asyncio.shield(future)
+        # someone may have created it while the backend was read
+        if chat_id in self.hot:
+            return self[chat_id]
+        return self._insert(chat_id, row)
+
+    def _insert(self, chat_id: int, row) -> UserChatThread:
+        thread = UserChatThread.from_dict(row[0]) if row is not None else UserChatThread()
+        self.hot[chat_id] = thread
+        self.versions[chat_id] = row[1] if row is not None else 0
+        if len(self.hot) > self.capacity and self.flush_now is not None:
+            self.flush_now.set()
+        return thread
+
+    def record_passive(self, chat_id: int, author: str, text: str):
+        """
+        Remembers a group message the bot doesn't answer, until the next addressed message takes it.
+        """
+        messages = self.passive.get(chat_id)
+        if messages is None:
+            messages = self.passive[chat_id] = deque(maxlen=PASSIVE_MESSAGES)
+            if len(self.passive) > PASSIVE_CHATS:
+                self.passive.popitem(last=False)
+        else:
+            self.passive.move_to_end(chat_id)
+        messages.append((author, text[:PASSIVE_CHARS]))
+
+    def take_passive(self, chat_id: int) -> list:
+        """
+        :return: the remembered group messages of the chat as (author, text), they are forgotten.
+        """
+        return list(self.passive.pop(chat_id, ()))
+
+    def pin(self, chat_id: int) -> UserChatThread:
+        """
+        Keeps the conversation in memory until `unpin`.
+        """
+        thread = self[chat_id]
+        self.pins[chat_id] = self.pins.get(chat_id, 0) + 1
+        return thread
+
+    def unpin(self, chat_id: int):
+        """
+        Releases a pin, the conversation is saved by the next flush.
+        """
+        self.pins[chat_id] -= 1
+        if self.pins[chat_id] == 0:
+            del self.pins[chat_id]
+
+    @contextmanager
+    def pinned(self, chat_id: int):
+        thread = self.pin(chat_id)
+        try:
+            yield thread
+        finally:
+            self.unpin(chat_id)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self.hot or self.backend.load(chat_id) is not None
+
+    def __len__(self) -> int:
+        return len(self.hot)
+
+    def _changed(self):
+        """
+        Takes a snapshot of the changed conversations and clears their flags.
+        """
+        items = []
+        for chat_id, thread in self.hot.items():
+            if thread.changed:
+                items.append((chat_id, thread.to_dict(), self.versions[chat_id]))
+                thread.changed = False
+        return items
+
+    def _saved(self, versions: dict):
+        for chat_id, version in versions.items():
+            if chat_id not in self.hot:
+                continue
+            if version is not None:
+                self.versions[chat_id] = version
+                continue
+            # another process saved the chat since it was loaded, its copy wins and ours is reloaded
+            logging.warning(f"Conversation {chat_id} was changed by another process, dropping the local copy")
+            if chat_id not in self.pins:
+                del self.hot[chat_id]
+                del self.versions[chat_id]
+
+    def _evict(self):
+        excess = len(self.hot) - self.capacity
+        if excess <= 0:
+            return
+
+        # the least recently used first, pinned ones and the ones changed since the save are skipped
+        evicted = list(islice((chat_id for chat_id, thread in self.hot.items()
+                               if chat_id not in self.pins and not thread.changed), excess))
+        if evicted:
+            logging.debug(f"Spilling {len(evicted)} conversations")
+            for chat_id in evicted:
+                del self.hot[chat_id]
+                del self.versions[chat_id]
+
+    async def flush(self):
+        """
+        Saves the changed in-memory conversations to the backend and spills the excess ones.
+        """
+        async with self.flush_lock:
+            items = self._changed()
+            if items:
+                try:
+                    versions = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self.backend.save_many, items)
+                except BaseException:
+                    # saved by the next flush
+                    for chat_id, _, _ in items:
+                        if chat_id in self.hot:
+                            self.hot[chat_id].changed = True
+                    raise
+                self._saved(versions)
+            self._evict()
+
+    async def _flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_now.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_now.clear()
+            try:
+                started = time.monotonic()
+                await self.flush()
+                logging.debug(f"Flushed conversations in {time.monotonic() - started:.3f}s")
+            except Exception as e:
+                logging.error(f"Flushing conversations failed: {e}")
+
+    def start(self):
+        """
+        Starts saving the changed conversations every `flush_seconds`, and as soon as there are more than
+        `capacity` of them in memory.
+        """
+        if self.flusher is None:
+            self.flush_now = asyncio.Event()
+            self.flusher = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+        await self.flush()
+        self.executor.shutdown()
+        self.backend.close()
@@ -0,0 +1,372 @@
+import asyncio
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from tokens import count_tokens
+
+# Document Q&A
+#
+# Uploaded documents are split into overlapping passages and indexed with BM25, one index per document
+# under DOCUMENTS_DIR/<chat id>/. The passages, their offsets and the postings are flat binary files that are
+# memory mapped when the chat asks a question, so only the pages touched by the query are read.
+# Indexing runs in a worker process, retrieval in a thread; both are lexical and work offline.
+# NumPy speeds up the scoring when it is installed, PDF documents need pypdf.
+
+DOCUMENTS_DIR = os.getenv("DOCUMENTS_DIR", "documents")
+# the Bot API doesn't let bots download bigger files
+MAX_DOCUMENT_BYTES = 20 * 1024 * 1024
+# documents kept per chat, the oldest index is dropped
+MAX_DOCUMENTS = int(os.getenv("MAX_DOCUMENTS", 5))
+CHUNK_CHARS = 1500
+CHUNK_OVERLAP = 200
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 4))
+# tokens of the prompt the retrieved passages may take
+RETRIEVAL_TOKENS = int(os.getenv("RETRIEVAL_TOKENS", 1500))
+# indexes kept mapped over all chats, the least recently used are unmapped
+MAX_OPEN_INDEXES = int(os.getenv("MAX_OPEN_INDEXES", 64))
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TEXT_EXTENSIONS = (".txt", ".md", ".markdown", ".rst", ".csv", ".log", ".json", ".html", ".xml")
+WORD = re.compile(r"\w+")
+
+# files of an index
+META = "meta.json"
+CHUNKS = "chunks.bin"       # utf-8 passages, back to back
+OFFSETS = "offsets.bin"     # int64, start of every passage plus the end
+LENGTHS = "lengths.bin"     # int32, number of terms of every passage
+POSTINGS = "postings.bin"   # int32 (passage, term frequency) pairs, grouped by term
+
+
+def terms(text: str) -> list:
+    return [word for word in WORD.findall(text.lower()) if len(word) > 1]
+
+
+def document_kind(file_name: str, mime_type: str):
+    """
+    :return: "pdf", "text" or None if the document is not supported.
+    """
+    file_name = (file_name or "").lower()
+    if file_name.endswith(".pdf") or mime_type == "application/pdf":
+        return "pdf"
+    if file_name.endswith(TEXT_EXTENSIONS) or (mime_type or "").startswith("text/"):
+        return "text"
+    return None
+
+
+def read_text(path: str):
+    with open(path, encoding="utf-8", errors="replace") as file:
+        yield from file
+
+
+def read_pdf(path: str):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ValueError("PDF documents need the pypdf package")
+
+    for page in PdfReader(path).pages:
+        yield (page.extract_text() or "") + "\n\n"
+
+
+def chunk_text(blocks, size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP):
+    """
+    Splits a stream of text blocks into passages of about `size` characters, cut on a paragraph,
+    line or word break. Consecutive passages share `overlap` characters so an answer isn't cut in half.
+    """
+    buffer = ""
+    for block in blocks:
+        buffer += block
+        while len(buffer) >= size:
+            cut = size
+            for separator in ("\n\n", "\n", " "):
+                index = buffer.rfind(separator, size // 2, size)
+                if index > 0:
+                    cut = index
+                    break
+
+            passage = buffer[:cut].strip()
+            if passage:
+                yield passage
+            start = buffer.find(" ", cut - overlap, cut)
+            buffer = buffer[start if start > 0 else cut - overlap:]
+
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def build_index(path: str, kind: str, directory: str, name: str) -> int:
+    """
+    Reads the document and writes its index into directory. Runs in a worker process.
+    :return: the number of passages.
+    """
+    reader = read_pdf if kind == "pdf" else read_text
+    building = directory + ".tmp"
+    os.makedirs(building)
+
+    postings = {}
+    offsets = array("q", [0])
+    lengths = array("i")
+    with open(os.path.join(building, CHUNKS), "wb") as chunks:
+        for index, passage in enumerate(chunk_text(reader(path))):
+            data = passage.encode()
+            chunks.write(data)
+            offsets.append(offsets[-1] + len(data))
+
+            words = terms(passage)
+            lengths.append(len(words))
+            for term, frequency in Counter(words).items():
+                postings.setdefault(term, array("i")).extend((index, frequency))
+
+    vocabulary = {}
+    flat = array("i")
+    for term in sorted(postings):
+        vocabulary[term] = (len(flat) // 2, len(postings[term]) // 2)
+        flat.extend(postings[term])
+
+    for file_name, values in ((OFFSETS, offsets), (LENGTHS, lengths), (POSTINGS, flat)):
+        with open(os.path.join(building, file_name), "wb") as file:
+            values.tofile(file)
+
+    count = len(lengths)
+    with open(os.path.join(building, META), "w") as file:
+        json.dump({"name": name, "passages": count, "avgdl": sum(lengths) / count if count else 0,
+                   "terms": vocabulary}, file)
+
+    os.rename(building, directory)
+    return count
+
+
+class DocumentIndex():
+    """
+    A memory mapped BM25 index of one document.
+    `users` counts the retrievals using it, the store only closes it when there are none.
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, META)) as file:
+            meta = json.load(file)
+        self.name = meta["name"]
+        self.passages = meta["passages"]
+        self.avgdl = meta["avgdl"] or 1
+        self.terms = meta["terms"]
+        self.users = 0
+
+        self.maps = []
+        self.views = []
+        self.chunks = self._map(os.path.join(directory, CHUNKS))
+        self.offsets = self._map(os.path.join(directory, OFFSETS), "q")
+        self.lengths = self._map(os.path.join(directory, LENGTHS), "i")
+        self.postings = self._map(os.path.join(directory, POSTINGS), "i")
+
+    def _map(self, path: str, format: str = None) -> memoryview:
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                view = memoryview(b"")
+            else:
+                self.maps.append(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+                view = memoryview(self.maps[-1])
+        self.views.append(view)
+        if format is not None:
+            view = view.cast(format)
+            self.views.append(view)
+        return view
+
+    def close(self):
+        # the casts are exports of the plain views, which are exports of the maps
+        for view in reversed(self.views):
+            view.release()
+        for map in self.maps:
+            map.close()
+        self.views = []
+        self.maps = []
+
+    def passage(self, index: int) -> str:
+        return bytes(self.chunks[self.offsets[index]:self.offsets[index + 1]]).decode()
+
+    def search(self, query: list, top_k: int) -> list:
+        """
+        :param query: the terms of the question.
+        :return: up to top_k (score, passage index) tuples, best first.
+        """
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        scores = numpy.zeros(self.passages) if numpy is not None else {}
+        for term in set(query):
+            entry = self.terms.get(term)
+            if entry is None:
+                continue
+            start, frequency = entry
+            idf = math.log(1 + (self.passages - frequency + 0.5) / (frequency + 0.5))
+            pairs = self.postings[2 * start:2 * (start + frequency)]
+
+            if numpy is not None:
+                pairs = numpy.frombuffer(pairs, dtype=numpy.int32).reshape(-1, 2)
+                passages, tf = pairs[:, 0], pairs[:, 1].astype(float)
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * numpy.frombuffer(self.lengths, dtype=numpy.int32)[passages] / self.avgdl)
+                scores[passages] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                continue
+
+            for index in range(0, len(pairs), 2):
+                passage, tf = pairs[index], pairs[index + 1]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[passage] / self.avgdl)
+                scores[passage] = scores.get(passage, 0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        if numpy is not None:
+            best = numpy.argsort(scores)[::-1][:top_k]
+            return [(float(scores[index]), int(index)) for index in best if scores[index] > 0]
+        return sorted(((score, passage) for passage, score in scores.items()), reverse=True)[:top_k]
+
+
+class DocumentStore():
+    """
+    The document indexes of the chats.
+    """
+
+    def __init__(self, directory: str = DOCUMENTS_DIR, max_documents: int = MAX_DOCUMENTS):
+        self.directory = directory
+        self.max_documents = max_documents
+        self.executor = None
+        # index directory -> DocumentIndex, the least recently used first; retrievals run in threads
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _chat_directory(self, chat_id: int) -> str:
+        return os.path.join(self.directory, str(chat_id))
+
+    def _index_directories(self, chat_id: int) -> list:
+        directory = self._chat_directory(chat_id)
+        if not os.path.isdir(directory):
+            return []
+        # indexes being built end with .tmp
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                if name.isdigit() and os.path.exists(os.path.join(directory, name, META))]
+
+    @contextmanager
+    def _open(self, directory: str):
+        """
+        Maps the index, or takes it from the cache. Indexes are closed once they are neither cached nor in use.
+        """
+        with self.lock:
+            index = self.indexes.get(directory)
+            if index is None:
+                index = self.indexes[directory] = DocumentIndex(directory)
+                while len(self.indexes) > MAX_OPEN_INDEXES:
+                    _, evicted = self.indexes.popitem(last=False)
+                    if evicted.users == 0:
+                        evicted.close()
+            self.indexes.move_to_end(directory)
+            index.users += 1
+        try:
+            yield index
+        finally:
+            with self.lock:
+                index.users -= 1
+                if index.users == 0 and self.indexes.get(directory) is not index:
+                    index.close()
+
+    def names(self, chat_id: int) -> list:
+        names = []
+        for directory in self._index_directories(chat_id):
+            with self._open(directory) as index:
+                names.append(index.name)
+        return names
+
+    async def add(self, chat_id: int, document) -> int:
+        """
+        Downloads a telegram document to a temporary file and indexes it.
+        :return: the number of passages.
+        """
+        kind = document_kind(document.file_name, document.mime_type)
+        if kind is None:
+            raise ValueError("Only text, markdown and PDF documents are supported")
+        if document.file_size and document.file_size > MAX_DOCUMENT_BYTES:
+            raise ValueError(f"Documents up to {MAX_DOCUMENT_BYTES // 2 ** 20}MB are supported")
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=1)
+
+        os.makedirs(self._chat_directory(chat_id), exist_ok=True)
+        target = os.path.join(self._chat_directory(chat_id), str(time.time_ns()))
+        with tempfile.TemporaryDirectory(dir=self.directory) as temporary:
+            path = os.path.join(temporary, "document")
+            await document.download(destination_file=path)
+            try:
+                passages = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, build_index, path, kind, target, document.file_name or "document")
+            except Exception:
+                shutil.rmtree(target + ".tmp", ignore_errors=True)
+                raise
+
+        for directory in self._index_directories(chat_id)[:-self.max_documents]:
+            self._remove(directory)
+        return passages
+
+    def _retrieve(self, chat_id: int, question: str, top_k: int, max_tokens: int, model: str) -> list:
+        query = terms(question)
+        if not query:
+            return []
+
+        results = []
+        for directory in self._index_directories(chat_id):
+            with self._open(directory) as index:
+                results.extend((score, directory, index.name, index.passage(passage))
+                               for score, passage in index.search(query, top_k))
+        results.sort(key=lambda result: result[0], reverse=True)
+
+        passages = []
+        for _, _, name, passage in results[:top_k]:
+            text = f"[{name}]\n{passage}"
+            tokens = count_tokens(text, model)
+            if tokens > max_tokens:
+                continue
+            max_tokens -= tokens
+            passages.append(text)
+        return passages
+
+    async def retrieve(self, chat_id: int, question: str, top_k: int = RETRIEVAL_TOP_K,
+                       max_tokens: int = RETRIEVAL_TOKENS, model: str = None) -> list:
+        """
+        Returns the passages of the chat's documents most relevant to the question, that fit into max_tokens.
+        """
+        if not os.path.isdir(self._chat_directory(chat_id)):
+            return []
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._retrieve, chat_id, question, top_k, max_tokens, model)
+
+    def _remove(self, directory: str):
+        with self.lock:
+            index = self.indexes.pop(directory, None)
+            # a retrieval still using it closes it when it is done
+            if index is not None and index.users == 0:
+                index.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def clear(self, chat_id: int):
+        for directory in self._index_directories(chat_id):
+            self._remove(directory)
+        logging.info(f"Documents of {chat_id} removed")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        with self.lock:
+            for index in self.indexes.values():
+                if index.users == 0:
+                    index.close()
+            self.indexes.clear()
@@ -0,0 +1,175 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+# Metrics
+#
+# Counters, gauges and histograms kept in plain dictionaries keyed by the tuple of label values,
+# so recording a value is a dictionary lookup and a few additions.
+# They are served in the Prometheus text format on http://127.0.0.1:METRICS_PORT/metrics (0 disables it).
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9090))
+LOOP_LAG_INTERVAL = 0.5  # seconds
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric():
+    kind = None
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield from super().render()
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. With `function` the value is read when the metrics are rendered.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def render(self):
+        yield from super().render()
+        if self.function is not None:
+            self.values[()] = self.function()
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            # a count per bucket plus +Inf, then the sum
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        yield from super().render()
+        for labels, series in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {total}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {series[-1]}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {total}"
+
+
+registry = []
+
+STAGE_SECONDS = Histogram("bot_stage_seconds", "Latency of the handler stages", ["stage"])
+ERRORS = Counter("bot_errors_total", "Errors reported to the users", ["stage"])
+TOKENS = Counter("bot_tokens_total", "Tokens used", ["model", "kind"])
+RETRIES = Counter("bot_openai_retries_total", "Retried OpenAI requests", ["model"])
+BACKEND_REQUESTS = Counter("bot_openai_backend_requests_total", "Requests sent to the OpenAI backends",
+                           ["backend", "outcome"])
+HEDGES = Counter("bot_openai_hedged_total", "Slow requests repeated on a second backend", ["model"])
+CONTEXT_FALLBACKS = Counter("bot_context_fallbacks_total", "Conversations that didn't fit the context", ["action"])
+LOOP_LAG = Histogram("bot_event_loop_lag_seconds", "Delay of the event loop callbacks",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """
+    Measures how late the event loop wakes up a sleeping task, a blocked loop shows up as lag.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(time.perf_counter() - start - interval, 0))
+
+
+_server = None
+
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """
+    Serves the metrics and starts the event loop lag monitor.
+    """
+    global _server
+    if not port:
+        return
+
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    _server = (runner, asyncio.create_task(monitor_loop_lag()))
+
+
+async def stop_server():
+    global _server
+    if _server is not None:
+        runner, lag_monitor = _server
+        lag_monitor.cancel()
+        await runner.cleanup()
+        _server = None
@@ -0,0 +1,22 @@
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+class ConversationMiddleware(BaseMiddleware):
+    """
+    Loads the conversation of the chat before the handler runs, so a cold one is read from the store's
+    backend off the event loop instead of on the first `conversations[chat_id]`.
+    """
+
+    def __init__(self, conversations, skip=None):
+        """
+        :param skip: a function telling the messages whose handler doesn't need the conversation.
+        """
+        self.conversations = conversations
+        self.skip = skip
+        super(ConversationMiddleware, self).__init__()
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if self.skip is not None and self.skip(message):
+            return
+        await self.conversations.load(message.chat.id)
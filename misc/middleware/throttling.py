@@ -1,26 +1,207 @@
-import asyncio
-
-from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.redis import RedisStorage2
-from aiogram.dispatcher import DEFAULT_RATE_LIMIT, Dispatcher
-from aiogram.dispatcher.handler import CancelHandler, current_handler
-from aiogram.dispatcher.middlewares import BaseMiddleware
-from aiogram.utils.exceptions import Throttled
-
-
-def rate_limit(limit: int, key=None):
-    """
-    Decorator for configuring rate limit and key in different functions.
-
-    :param limit:
-    :param key:
-    :return:
-    """
-
-    def decorator(func):
-        setattr(func, 'throttling_rate_limit', limit)
-        if key:
-            setattr(func, 'throttling_key', key)
-        return func
-
-    return decorator
+import os
+import time
+
+from aiogram import types
+from aiogram.dispatcher import DEFAULT_RATE_LIMIT
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.storage import DELTA, EXCEEDED_COUNT, KEY, RATE_LIMIT
+from aiogram.utils.exceptions import Throttled
+
+# seconds between messages of a user, handlers override it with @rate_limit
+USER_RATE_LIMIT = float(os.getenv("USER_RATE_LIMIT", 2))
+USER_BURST = int(os.getenv("USER_BURST", 5))
+# seconds between messages of a group chat
+CHAT_RATE_LIMIT = float(os.getenv("CHAT_RATE_LIMIT", 1))
+CHAT_BURST = int(os.getenv("CHAT_BURST", 10))
+# "memory" keeps the buckets in each process, "redis" shares them between the processes through REDIS_URL
+THROTTLE_BACKEND = os.getenv("THROTTLE_BACKEND", "memory")
+# the share of the bot-wide limits this process may use, the webhook gives each of its N workers 1/N
+LIMIT_SHARE = float(os.getenv("LIMIT_SHARE", 1))
+# buckets shared through Redis already see the messages of every process
+BUCKET_SHARE = 1.0 if THROTTLE_BACKEND == "redis" else LIMIT_SHARE
+# messages per second over all chats
+GLOBAL_RATE = float(os.getenv("GLOBAL_RATE", 20)) * BUCKET_SHARE
+GLOBAL_BURST = max(1, int(int(os.getenv("GLOBAL_BURST", 40)) * BUCKET_SHARE))
+
+
+def rate_limit(limit: int, key=None):
+    """
+    Decorator for configuring rate limit and key in different functions.
+
+    :param limit:
+    :param key:
+    :return:
+    """
+
+    def decorator(func):
+        setattr(func, 'throttling_rate_limit', limit)
+        if key:
+            setattr(func, 'throttling_key', key)
+        return func
+
+    return decorator
+
+
+class TokenBucket():
+    __slots__ = ("tokens", "updated", "exceeded")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.exceeded = 0
+
+
+class MemoryBucketBackend():
+    """
+    Token buckets kept in the memory of the process.
+    Buckets idle for 10 minutes are dropped once there are more than `max_buckets`.
+    """
+
+    def __init__(self, max_buckets: int = 10000):
+        self.max_buckets = max_buckets
+        self.buckets = {}
+
+    async def consume(self, key: str, rate: float, burst: int):
+        """
+        Takes a token from the bucket.
+
+        :param rate: tokens added per second.
+        :param burst: capacity of the bucket.
+        :return: a tuple (allowed, seconds until a token is available, number of consecutive rejections).
+        """
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self._sweep(now)
+            bucket = self.buckets[key] = TokenBucket(burst, now)
+
+        bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+        bucket.updated = now
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.exceeded = 0
+            return True, 0, 0
+
+        bucket.exceeded += 1
+        return False, (1 - bucket.tokens) / rate, bucket.exceeded
+
+    def _sweep(self, now: float):
+        # an idle bucket has refilled, so it is indistinguishable from a new one
+        idle = [key for key, bucket in self.buckets.items() if now - bucket.updated > 60 * 10]
+        for key in idle:
+            del self.buckets[key]
+
+
+class RedisBucketBackend():
+    """
+    Token buckets kept in Redis, shared by all the processes of the bot.
+    Requires the `redis` package.
+    """
+
+    SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated', 'exceeded')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+local exceeded = tonumber(bucket[3]) or 0
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+    exceeded = 0
+else
+    retry_after = (1 - tokens) / rate
+    exceeded = exceeded + 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now), 'exceeded', exceeded)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(retry_after), exceeded}
+"""
+
+    def __init__(self, url: str = None, prefix: str = "throttling:"):
+        import redis.asyncio as redis
+        self.redis = redis.from_url(url or os.getenv("REDIS_URL", "redis://localhost"))
+        self.prefix = prefix
+        self.script = self.redis.register_script(self.SCRIPT)
+
+    async def consume(self, key: str, rate: float, burst: int):
+        allowed, retry_after, exceeded = await self.script(keys=[self.prefix + key], args=[rate, burst, time.time()])
+        return bool(allowed), float(retry_after), int(exceeded)
+
+
+def bucket_backend(prefix: str, kind: str = None):
+    """
+    Creates the token bucket backend picked by THROTTLE_BACKEND.
+
+    :param prefix: namespace of the keys in a shared backend.
+    """
+    kind = kind or THROTTLE_BACKEND
+    if kind == "redis":
+        return RedisBucketBackend(prefix=prefix)
+    if kind != "memory":
+        raise ValueError(f"Unknown THROTTLE_BACKEND {kind}")
+    return MemoryBucketBackend()
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Drops messages before they reach the handler when the user, the chat or the bot
+    as a whole exceed their token bucket.
+    The user limit is taken from the handler's @rate_limit, the key groups the handlers sharing one bucket.
+    The buckets are checked from the narrowest to the widest, so a message rejected for its user or chat
+    doesn't take a token from the buckets shared with everyone else.
+    """
+
+    def __init__(self, limit: float = USER_RATE_LIMIT, key_prefix: str = 'antiflood_', backend=None, is_passive=None):
+        """
+        :param is_passive: a function telling the messages the bot only remembers, e.g. group chatter not
+                           addressed to it. They cost nothing, so only the user bucket applies to them.
+        """
+        self.rate_limit = limit or DEFAULT_RATE_LIMIT
+        self.prefix = key_prefix
+        self.backend = backend if backend is not None else bucket_backend("throttling:")
+        self.is_passive = is_passive
+        super(ThrottlingMiddleware, self).__init__()
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        handler = current_handler.get()
+        if handler:
+            limit = getattr(handler, 'throttling_rate_limit', self.rate_limit)
+            key = getattr(handler, 'throttling_key', f"{self.prefix}_{handler.__name__}")
+        else:
+            limit = self.rate_limit
+            key = f"{self.prefix}_message"
+
+        allowed, retry_after, exceeded = await self.backend.consume(f"{key}:{message.from_user.id}", 1 / limit, USER_BURST)
+        if not allowed:
+            throttled = Throttled(**{KEY: key, RATE_LIMIT: limit, DELTA: retry_after, EXCEEDED_COUNT: exceeded,
+                                     'user': message.from_user.id, 'chat': message.chat.id})
+            await self.message_throttled(message, throttled)
+            raise CancelHandler()
+
+        if self.is_passive is not None and self.is_passive(message):
+            return
+
+        if message.chat.type != types.ChatType.PRIVATE:
+            allowed, _, _ = await self.backend.consume(f"chat:{message.chat.id}", 1 / CHAT_RATE_LIMIT, CHAT_BURST)
+            if not allowed:
+                raise CancelHandler()
+
+        # only the admitted messages count against the bot as a whole
+        allowed, _, _ = await self.backend.consume("global", GLOBAL_RATE, GLOBAL_BURST)
+        if not allowed:
+            raise CancelHandler()
+
+    async def message_throttled(self, message: types.Message, throttled: Throttled):
+        # warn only once and not in groups, further messages are dropped silently
+        if throttled.exceeded_count == 1 and message.chat.type == types.ChatType.PRIVATE:
+            # imported here, the send queue uses the buckets of this module
+            from send_queue import send_queue
+            await send_queue.reply(message, f"Too many requests! Please wait {throttled.delta:.1f} sec.")
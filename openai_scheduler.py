@@ -0,0 +1,309 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+
+from metrics import RETRIES
+
+# lower runs first
+INTERACTIVE = 0
+TRANSCRIPTION = 1
+BACKGROUND = 2
+
+MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", 16))
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_MAX = 60.0  # seconds
+
+# requests and tokens per minute, the longest matching prefix wins
+MODEL_LIMITS = {
+    "gpt-3.5-turbo": (3500, 90000),
+    "gpt-3.5-turbo-16k": (3500, 180000),
+    "gpt-4": (200, 40000),
+    "whisper-1": (50, 0),
+    "tts-1": (50, 0),
+}
+DEFAULT_LIMITS = (500, 60000)
+# the limits of the account, a JSON object overriding the ones above, "*" for the models not listed, e.g.
+#   {"gpt-4": [500, 80000], "*": [1000, 100000]}
+OPENAI_MODEL_LIMITS = os.getenv("OPENAI_MODEL_LIMITS")
+if OPENAI_MODEL_LIMITS:
+    MODEL_LIMITS.update({model: tuple(limits) for model, limits in json.loads(OPENAI_MODEL_LIMITS).items()})
+    DEFAULT_LIMITS = MODEL_LIMITS.pop("*", DEFAULT_LIMITS)
+# the share of the account limits this process may use, the webhook gives each of its N workers 1/N
+LIMIT_SHARE = float(os.getenv("LIMIT_SHARE", 1))
+
+
+def model_limits(model: str):
+    # backends keep separate limits, their windows are keyed by "backend/model"
+    model = model.rsplit("/", 1)[-1] if model else model
+    prefixes = [name for name in MODEL_LIMITS if model and model.startswith(name)]
+    requests, tokens = MODEL_LIMITS[max(prefixes, key=len)] if prefixes else DEFAULT_LIMITS
+    return max(1, int(requests * LIMIT_SHARE)), int(tokens * LIMIT_SHARE)
+
+
+def parse_duration(value: str) -> float:
+    """
+    Parses the durations used by the rate limit headers, e.g. "20ms", "1s", "6m0s".
+    """
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value or ""):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+def retry_after(error) -> float:
+    """
+    Returns how long the API asked us to wait, or None if the error doesn't say.
+    """
+    headers = getattr(error, "headers", None) or {}
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+
+    resets = [parse_duration(headers.get(name)) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+    return max(resets) or None
+
+
+def is_retryable(error) -> bool:
+    from openai.error import APIConnectionError, RateLimitError, ServiceUnavailableError, Timeout, TryAgain
+
+    if isinstance(error, (RateLimitError, ServiceUnavailableError, APIConnectionError, Timeout, TryAgain)):
+        return True
+    return (getattr(error, "http_status", None) or 0) >= 500
+
+
+class RateWindow():
+    """
+    Sliding one minute window of the requests and tokens sent to a model.
+    """
+    __slots__ = ("requests_per_minute", "tokens_per_minute", "sent", "tokens", "paused_until")
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.sent = deque()  # [time, tokens]
+        self.tokens = 0
+        self.paused_until = 0.0
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        """
+        Returns 0 if a request of `tokens` fits into the window now, otherwise the seconds to wait.
+        """
+        while self.sent and self.sent[0][0] <= now - 60:
+            self.tokens -= self.sent.popleft()[1]
+
+        if self.paused_until > now:
+            return self.paused_until - now
+
+        if len(self.sent) >= self.requests_per_minute:
+            return self.sent[0][0] + 60 - now
+
+        # a request larger than the whole budget is let through once the window is empty
+        if self.tokens_per_minute and self.sent and self.tokens + tokens > self.tokens_per_minute:
+            excess = self.tokens + tokens - self.tokens_per_minute
+            for sent_at, sent_tokens in self.sent:
+                excess -= sent_tokens
+                if excess <= 0:
+                    return sent_at + 60 - now
+        return 0
+
+    def add(self, tokens: int, now: float) -> list:
+        """
+        :return: the entry of the request, to `correct` it once its real size is known.
+        """
+        entry = [now, tokens]
+        self.sent.append(entry)
+        self.tokens += tokens
+        return entry
+
+    def correct(self, entry: list, tokens: int):
+        """
+        Replaces the estimated tokens of a request with the ones it really used.
+        """
+        # an entry older than the window is gone or about to be, it no longer counts
+        if entry[0] > time.monotonic() - 60:
+            self.tokens += tokens - entry[1]
+            entry[1] = tokens
+
+
+class HeldStream():
+    """
+    A streamed response that holds its in-flight slot until it is exhausted, fails or is closed.
+    Collects the streamed text, so the tokens of the request can be corrected at the end.
+    """
+
+    def __init__(self, chunks, done):
+        """
+        :param done: called once with the streamed text.
+        """
+        self.chunks = chunks
+        self.done = done
+        self.text = []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self.chunks.__anext__()
+        except BaseException:
+            self._finish()
+            raise
+        for choice in chunk.get("choices") or ():
+            self.text.append(choice.get("delta", {}).get("content") or "")
+        return chunk
+
+    async def aclose(self):
+        self._finish()
+        if hasattr(self.chunks, "aclose"):
+            await self.chunks.aclose()
+
+    def _finish(self):
+        if self.done is not None:
+            done, self.done = self.done, None
+            done("".join(self.text))
+
+
+class RequestScheduler():
+    """
+    Single entry point for the OpenAI calls.
+    Caps the requests in flight, keeps every model within its requests and tokens per minute,
+    serves interactive requests before background ones and retries transient failures
+    with jittered exponential backoff, honoring the rate limit headers.
+    """
+
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT, max_retries: int = MAX_RETRIES):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.waiting = []  # heap of (priority, sequence, model, tokens, future)
+        self.windows = {}
+        self.sequence = itertools.count()
+        self.timer = None
+
+    def window(self, model: str) -> RateWindow:
+        window = self.windows.get(model)
+        if window is None:
+            window = self.windows[model] = RateWindow(*model_limits(model))
+        return window
+
+    def _dispatch(self):
+        self.timer = None
+        now = time.monotonic()
+        next_check = None
+
+        blocked = []
+        while self.waiting and self.in_flight < self.max_in_flight:
+            entry = heapq.heappop(self.waiting)
+            priority, _, model, tokens, future = entry
+            if future.done():
+                continue
+
+            wait = self.window(model).wait_time(tokens, now)
+            if wait > 0:
+                blocked.append(entry)
+                next_check = wait if next_check is None else min(next_check, wait)
+                continue
+
+            entry = self.window(model).add(tokens, now)
+            self.in_flight += 1
+            future.set_result(entry)
+
+        for entry in blocked:
+            heapq.heappush(self.waiting, entry)
+
+        if next_check is not None:
+            self.timer = asyncio.get_running_loop().call_later(next_check, self._dispatch)
+
+    async def _acquire(self, priority: int, model: str, tokens: int) -> list:
+        """
+        :return: the window entry of the admitted request.
+        """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.sequence), model, tokens, future))
+        if self.timer is not None:
+            self.timer.cancel()
+        self._dispatch()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # admitted, but cancelled before it could run
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        if self.timer is not None:
+            self.timer.cancel()
+        self._dispatch()
+
+    def _streamed(self, model: str, entry: list, tokens: int, reserve: int):
+        def done(text: str):
+            self._release()
+            if reserve:
+                from tokens import count_tokens
+                self.window(model).correct(entry, tokens - reserve + count_tokens(text, model.rsplit("/", 1)[-1]))
+        return done
+
+    async def call(self, fn, *args, priority: int = INTERACTIVE, tokens: int = 0, limits: str = None,
+                   retries: int = None, reserve: int = 0, **kwargs):
+        """
+        Runs `fn(*args, **kwargs)` once the scheduler admits it, retrying transient failures.
+        The tokens of the request are corrected with the usage the response reports.
+        A streamed response holds its in-flight slot until it is exhausted or closed.
+
+        :param priority: INTERACTIVE, TRANSCRIPTION or BACKGROUND.
+        :param tokens: the estimated number of tokens the request consumes.
+        :param limits: the model whose rate limits apply, by default the model or engine argument.
+        :param retries: how often a transient failure is retried, by default max_retries.
+        :param reserve: the part of `tokens` reserved for the completion, a stream reports no usage, so this part
+                        is replaced with the tokens of the streamed text.
+        """
+        model = limits or kwargs.get("model") or kwargs.get("engine")
+        retries = self.max_retries if retries is None else retries
+
+        for attempt in range(retries + 1):
+            entry = await self._acquire(priority, model, tokens)
+            held = False
+            try:
+                result = await fn(*args, **kwargs)
+                if hasattr(result, "__anext__"):
+                    held = True
+                    return HeldStream(result, self._streamed(model, entry, tokens, reserve))
+                if isinstance(result, dict) and result.get("usage"):
+                    self.window(model).correct(entry, result["usage"]["total_tokens"])
+                return result
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+
+                error = e
+                delay = retry_after(e)
+                if delay is not None:
+                    delay += random.uniform(0, BACKOFF_BASE)
+                    # the limit is shared, hold back the other requests to the model too
+                    self.window(model).paused_until = time.monotonic() + delay
+                if attempt == retries:
+                    raise
+                if delay is None:
+                    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            finally:
+                if not held:
+                    self._release()
+
+            logging.warning(f"{model} request failed ({error}), retry {attempt + 1} in {delay:.1f}s")
+            RETRIES.inc(model)
+            await asyncio.sleep(delay)
+
+
+scheduler = RequestScheduler()
@@ -1,28 +1,62 @@
+import asyncio
 import logging
 
 # configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-import os
 import re
-from collections import defaultdict
+import signal
+import sys
 
 import openai
 from aiogram import Bot, types, executor
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.dispatcher import Dispatcher
 from aiogram.types import ContentType, ParseMode, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, ChatActions
-from aiogram.utils.exceptions import CantParseEntities
 
-from api_key import bot_token, engine, bot_name, DEFAULT_MODEL
-from user_thread import UserChatThread, ModelStats
-from text_utils import entities_extract, fetch_url, is_markdown
-
-conversations = defaultdict(UserChatThread)
-
-bot = Bot(token=bot_token)
+from api_key import bot_token, engine, bot_name, DEFAULT_MODEL, telegram_api_server
+from conversation_store import ConversationStore, SQLiteBackend
+from text_utils import entities_extract, fetch_urls, close_session, is_markdown, PAGE_TOKENS
+from tokens import count_tokens, context_limit, truncate, BIG_CONTEXT_MODEL, COMPLETION_RESERVE
+from streaming import StreamingReply
+from voice import VoicePipeline, VOICE_MODEL
+from chat_actor import ChatActors
+from summarizer import Summarizer
+from documents import DocumentStore
+from send_queue import send_queue
+from speech import Speaker, VoiceReply
+from usage import UsageLedger, PROMPT_TOKENS, COMPLETION_TOKENS, VOICE_SECONDS, REQUESTS, SPEECH_CHARACTERS
+from openai_scheduler import scheduler, INTERACTIVE, BACKGROUND
+from backends import pool
+from metrics import STAGE_SECONDS, ERRORS, TOKENS, CONTEXT_FALLBACKS, Gauge
+import metrics
+from misc.middleware.throttling import ThrottlingMiddleware, rate_limit
+from misc.middleware.conversations import ConversationMiddleware
+
+conversations = ConversationStore(SQLiteBackend())
+voice_pipeline = VoicePipeline()
+pending_suggestions = {}
+chat_actors = ChatActors(conversations)
+ledger = UsageLedger()
+summarizer = Summarizer(conversations, ledger)
+documents = DocumentStore()
+speaker = Speaker()
+
+Gauge("bot_voice_queue", "Voice messages waiting for a transcoding worker", function=lambda: voice_pipeline.queued)
+Gauge("bot_openai_in_flight", "OpenAI requests in flight", function=lambda: scheduler.in_flight)
+Gauge("bot_openai_waiting", "OpenAI requests waiting in the scheduler", function=lambda: len(scheduler.waiting))
+Gauge("bot_hot_conversations", "Conversations kept in memory", function=lambda: len(conversations))
+Gauge("bot_send_queue", "Telegram requests waiting in the send queue", function=lambda: send_queue.queued())
+
+if telegram_api_server:
+    bot = Bot(token=bot_token, server=TelegramAPIServer.from_base(telegram_api_server))
+else:
+    bot = Bot(token=bot_token)
 dp = Dispatcher(bot)
+# is_passive is defined with the handlers below
+dp.middleware.setup(ThrottlingMiddleware(is_passive=lambda message: is_passive(message)))
+dp.middleware.setup(ConversationMiddleware(conversations, skip=lambda message: is_passive(message)))
 
-VOICE_MODEL = "whisper-1"
 GPT4_MODEL = "gpt-4"
 GPT4_MAX_TOKENS = 8000
 
@@ -34,12 +68,13 @@ GPT4_MAX_TOKENS = 8000
 # /role, set the role of the user
 # /stats, show usage statistics
 # /suggestions <number>, show <number> suggestions in keyboard
+# /stream on|off, stream answers while they are generated
 # /help writes the help message
 
 @dp.message_handler(commands=['help'])
 async def handle_help(message):
     logging.info("user %s requested help", message.from_user.id)
-    await message.answer("This is a chatbot that uses OpenAI's API to generate responses to your messages. \n"
+    await send_queue.answer(message, "This is a chatbot that uses OpenAI's API to generate responses to your messages. \n"
                          "- You can start a new conversation by typing /new. \n"
                          "- You can set bot role in the conversation by typing /role. \n"
                          "- You can also send voice messages to the bot and it will transcribe them.")
@@ -47,9 +82,10 @@ async def handle_help(message):
 
 @dp.message_handler(commands=['new'])
 async def start_message(message: types.Message):
-    conversations[message.from_user.id].reset()
-    logging.info(f"Starting new conversation for {message.from_user.id}")
-    await message.reply("New conversation started. Type /help for more information.",
+    conversations[message.chat.id].reset()
+    conversations.take_passive(message.chat.id)
+    logging.info(f"Starting new conversation for {message.chat.id}")
+    await send_queue.reply(message, "New conversation started. Type /help for more information.",
                         reply_markup=ReplyKeyboardRemove())
 
 
@@ -59,100 +95,155 @@ async def set_role(message: types.Message):
 
     if len(message.text) < 6:
         logging.info("No role specified")
-        current_role = conversations[message.from_user.id].system["content"]    
-        await message.reply(f"Please specify a role with /role <role>\n'{current_role}' is the current role.")
+        current_role = conversations[message.chat.id].system["content"]    
+        await send_queue.reply(message, f"Please specify a role with /role <role>\n'{current_role}' is the current role.")
         return
 
-    conversations[message.from_user.id].system["content"] = message.text[6:]
+    conversations[message.chat.id].set_system(message.text[6:])
+
+
+def rollup_str(rollup: list) -> str:
+    return (f"{rollup[REQUESTS]} requests, {rollup[PROMPT_TOKENS]} prompt + {rollup[COMPLETION_TOKENS]} completion tokens, "
+            f"{rollup[VOICE_SECONDS]:.0f} sec of voice, {rollup[SPEECH_CHARACTERS]} characters spoken")
 
 
 @dp.message_handler(commands=['stats'])
 async def usage_message(message: types.Message):
-    conversation = conversations[message.from_user.id]
+    conversation = conversations[message.chat.id]
+    user_id = message.from_user.id
 
-    if len(conversation.models) == 0:
-        await message.answer("No usage statistics available.")
+    if ledger.usage("user", user_id, "month")[REQUESTS] == 0:
+        await send_queue.answer(message, "No usage statistics available.")
         return
 
     answer = ""
-    total_messages = 0
-    for name, value in conversation.models.items():
-        stats: ModelStats = value
-        total_messages += stats.messages
-        answer += f"**{name}**:\n {stats.str()}\n"
-        
-
-    await message.answer(
-        f"Total messages: {total_messages} in {conversation.sessions} sessions, "
-        f"{conversation.session_messages} in this session. \n"
-        f"Messages per session: {conversation.session_messages / conversation.sessions:.1f} \n"
-
-        f"Total voice messages: {conversation.voice_messages} ({conversation.duration_seconds} sec), "
-        f"{conversation.session_voice_messages} ({conversation.session_duration_seconds} sec) in this session. \n"
-        f"Voice messages per session: {conversation.session_voice_messages / conversation.sessions:.1f} \n"
+    for name in conversation.models:
+        answer += f"**{name}**: {rollup_str(ledger.usage('user', user_id, 'month', name))}\n"
 
+    await send_queue.answer(message, 
+        f"Today: {rollup_str(ledger.usage('user', user_id, 'day'))}\n"
+        f"This month: {rollup_str(ledger.usage('user', user_id, 'month'))}\n"
         f"{answer}\n"
+        f"Sessions: {conversation.sessions}, {conversation.session_messages} messages and "
+        f"{conversation.session_voice_messages} voice messages ({conversation.session_duration_seconds} sec) in this session.\n"
+        f"Voice pipeline: {voice_pipeline.str()}\n"
+        f"Backends: {pool.str()}"
     )
 
 
 @dp.message_handler(commands=['suggestions'])
 async def suggestions_message(message: types.Message):
-    conversation = conversations[message.from_user.id]
+    conversation = conversations[message.chat.id]
 
     if len(message.text) < 12:
         logging.info("No suggestions specified")
-        await message.reply("Please specify a number of suggestions with /suggestions <number>")
+        await send_queue.reply(message, "Please specify a number of suggestions with /suggestions <number>")
         return
 
     conversation.suggestions = int(message.text[12:])
 
 
-@dp.message_handler(content_types=ContentType.DOCUMENT)
-async def handle_document(message: types.Message):
-    await message.answer("Not implemented yet")
+@dp.message_handler(commands=['stream'])
+async def stream_message(message: types.Message):
+    conversation = conversations[message.chat.id]
 
+    argument = message.get_args().strip().lower()
+    if argument not in ("on", "off"):
+        state = "on" if conversation.streaming else "off"
+        await send_queue.reply(message, f"Please specify /stream on|off\nStreaming is {state}.")
+        return
 
-@dp.message_handler(content_types=ContentType.VOICE)
-async def handle_voice(message: types.Message):
+    conversation.streaming = argument == "on"
+
+
+@dp.message_handler(commands=['voice'])
+async def voice_message(message: types.Message):
     conversation = conversations[message.chat.id]
 
-    temp_name = f"/tmp/{message.voice.file_unique_id}.mp3"
+    argument = message.get_args().strip().lower()
+    if argument not in ("on", "off"):
+        state = "on" if conversation.voice_replies else "off"
+        await send_queue.reply(message, f"Please specify /voice on|off\nVoice replies are {state}.")
+        return
+
+    conversation.voice_replies = argument == "on"
+
+
+@dp.message_handler(commands=['documents'])
+async def documents_message(message: types.Message):
+    if message.get_args().strip().lower() == "clear":
+        documents.clear(message.chat.id)
+        conversations[message.chat.id].set_passages([])
+        await send_queue.reply(message, "Documents removed.")
+        return
+
+    names = documents.names(message.chat.id)
+    if not names:
+        await send_queue.reply(message, "No documents. Send a text, markdown or PDF file to ask questions about it.")
+        return
+    await send_queue.reply(message, "Documents:\n" + "\n".join(names) + "\n\nUse /documents clear to remove them.")
+
 
-    await message.answer_chat_action(ChatActions.RECORD_AUDIO)
+@dp.message_handler(content_types=ContentType.DOCUMENT)
+@rate_limit(5, 'document')
+async def handle_document(message: types.Message):
+    send_queue.chat_action(message, ChatActions.UPLOAD_DOCUMENT)
     try:
-        logging.debug(f"Downloading voice file to {temp_name}")
-        await message.voice.download(destination_file=temp_name)
+        with STAGE_SECONDS.time("document_index"):
+            passages = await documents.add(message.chat.id, message.document)
+    except ValueError as e:
+        await send_queue.reply(message, str(e))
+        return
+    except Exception as e:
+        logging.error(e)
+        ERRORS.inc("document")
+        await send_queue.answer(message, "Error occured. Please try again later.")
+        return
+
+    await send_queue.reply(message, f"Indexed {passages} passages of {message.document.file_name}. Ask me about it.")
+
+    # the caption is the first question
+    if message.caption:
+        message.text = message.caption
+        message.entities = message.caption_entities
+        await default_text_handler(message)
+
 
-        from pydub import AudioSegment
-        song = AudioSegment.from_ogg(temp_name)
+@dp.message_handler(content_types=ContentType.VOICE)
+@rate_limit(5, 'voice')
+async def handle_voice(message: types.Message):
+    # group voice not addressed to the bot is not worth a transcription
+    if not is_addressed(message):
+        return
 
-        first_10_minutes = song[:10 * 60 * 1000]  # 10 minutes PyDub handles time in milliseconds
-        first_10_minutes.export(temp_name, format="mp3")
+    reason = ledger.check(message.from_user.id, message.chat.id, voice_seconds=message.voice.duration)
+    if reason:
+        await send_queue.reply(message, reason)
+        return
 
-        conversation.increase_voice_usage(song.duration_seconds)
+    send_queue.chat_action(message, ChatActions.RECORD_AUDIO)
+    try:
+        prompt = conversations[message.chat.id].history[-1]["content"]
+        with STAGE_SECONDS.time("handle_voice"):
+            text, duration = await voice_pipeline.transcribe(message.voice, prompt=prompt)
 
-        with open(temp_name, "rb") as audio_file:
-            logging.debug(f"Transcribing {temp_name}")
-            prompt = conversations[message.from_user.id].history[-1]["content"]
-            transcript = openai.Audio.transcribe(VOICE_MODEL, audio_file, prompt=prompt)
-            text = transcript["text"]
+        # looked up after the transcription, the conversation may have been spilled meanwhile
+        conversations[message.chat.id].increase_voice_usage(duration)
+        ledger.record(message.from_user.id, message.chat.id, VOICE_MODEL, voice_seconds=duration)
 
-        await message.reply(f"_> {text}_", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        await send_queue.reply(message, f"_> {text}_", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
 
         message.text = text
         await default_text_handler(message)
 
     except Exception as e:
         logging.error(e)
-        await message.answer("Error occured. Please try again later.")
-    finally:
-        # delete the file after if it exists
-        if os.path.exists(temp_name):
-            logging.debug(f"Deleting {temp_name}")
-            os.remove(temp_name)
+        ERRORS.inc("voice")
+        await send_queue.answer(message, "Error occured. Please try again later.")
 
 
 @dp.message_handler(commands=['gpt4'])
+@rate_limit(10, 'gpt4')
 async def gpt4(message: types.Message):
     await default_text_handler(message, model=GPT4_MODEL)
 
@@ -162,11 +253,11 @@ async def handle_sticker(message: types.Message):
     emoji = message.sticker.emoji
 
     if emoji == '👍' or '👌':
-        await message.answer("thanks!")
+        await send_queue.answer(message, "thanks!")
     elif emoji == '👎':
-        await message.answer("sorry to hear that")
+        await send_queue.answer(message, "sorry to hear that")
         
-    await message.answer(emoji)
+    await send_queue.answer(message, emoji)
 
 @dp.message_handler(content_types=ContentType.TEXT)
 async def default_text_handler(message: types.Message, model: str = DEFAULT_MODEL):
@@ -174,13 +265,81 @@ async def default_text_handler(message: types.Message, model: str = DEFAULT_MODE
         await text_handler(message, model)
     except Exception as e:
         logging.error(e)
-        await message.answer("Error occured. Please try again later.\n"+str(e))
+        ERRORS.inc("text")
+        await send_queue.answer(message, "Error occured. Please try again later.\n"+str(e))
 
         conversation = conversations[message.chat.id]
         conversation.increase_error(model)
 
 
+def is_addressed(message: types.Message) -> bool:
+    """
+    Checks if the bot has to answer the message: private chats, mentions and replies to the bot.
+    """
+    if message.chat.type == types.ChatType.PRIVATE:
+        return True
+
+    if message.reply_to_message and message.reply_to_message.from_user.is_bot:
+        return True
+
+    if message.entities:
+        return "@"+bot_name in entities_extract(message.text, message.entities)["mention"]
+
+    # e.g. a voice message mentioning the bot in its caption
+    if message.caption_entities:
+        return "@"+bot_name in entities_extract(message.caption, message.caption_entities)["mention"]
+
+    return False
+
+
+def is_passive(message: types.Message) -> bool:
+    """
+    Checks if the message is group chatter the bot doesn't answer: text that isn't a command and doesn't address
+    it, which is only remembered, and voice that doesn't address it, which is ignored.
+    """
+    return message.content_type in (ContentType.TEXT, ContentType.VOICE) and not message.is_command() and \
+        not is_addressed(message)
+
+
 async def text_handler(message: types.Message, model=DEFAULT_MODEL):
+    """
+    Adds the message to the conversation and schedules the answer.
+    Messages of a chat are processed one at a time, messages sent in quick succession
+    are answered together and a newer message cancels the answer in flight.
+    Group messages that don't address the bot are only remembered until it is addressed.
+    """
+    chat_id = message.chat.id
+    if not is_addressed(message):
+        # passive: no chat action, no fetch, no answer, the message only waits in the chat's ring buffer
+        if message.text:
+            conversations.record_passive(chat_id, message.from_user.first_name or message.from_user.username, message.text)
+        return
+
+    # users over their quota are turned away before anything is fetched or queued
+    reason = ledger.check(message.from_user.id, chat_id, tokens=1)
+    if reason:
+        await send_queue.reply(message, reason)
+        return
+
+    actor = chat_actors.acquire(chat_id)
+    try:
+        cancel_suggestions(chat_id)
+        actor.cancel()
+
+        async with actor.lock:
+            if not await ingest(message):
+                return
+    finally:
+        chat_actors.release(chat_id)
+
+    chat_actors.schedule(chat_id, lambda: answer_handler(message, model))
+
+
+async def ingest(message: types.Message) -> bool:
+    """
+    Appends the message to the conversation, the content of the linked pages is inlined.
+    :return: False if the message was rejected.
+    """
     logging.debug(message.to_python())
 
     context = {
@@ -194,64 +353,85 @@ async def text_handler(message: types.Message, model=DEFAULT_MODEL):
     }
 
     conversation = conversations[message.chat.id]
-    is_private = message.chat.type == types.ChatType.PRIVATE
 
     message_text = message.text
     
-    mentioned = False
     if message.entities:
         entities = entities_extract(message_text, message.entities)
-        # Filter the entities to keep only mentions
-        mentions = entities["mention"] # entities_extract(message_text, message.entities, "mention")
         
         pref_name = "@"+bot_name
-        if pref_name in mentions:
-            mentioned = True
+        if pref_name in entities["mention"]:
             message_text = message_text.replace(pref_name, "")
 
         if message_text.startswith("/gpt4 "):
             message_text = message_text[6:]
 
-        # Filter the entities to keep only mentions
+        # Filter the entities to keep only urls
         url_entities = entities["url"]
         if url_entities:
-            for url_entity in url_entities:
-                if url_entity.startswith("https://t.me/"):
-                    await message.reply("Please don't send links to other chats.")
-                    return
-
-                try:
-                    res = fetch_url(url_entity)
-                    message_text = message_text.replace(url_entity, '\n>>'+ res.text_content )
-                except Exception as e:
-                    logging.error(e)
-                    #await message.answer("Error occured. Please try again later.\n"+str(e))
+            if any(url_entity.startswith("https://t.me/") for url_entity in url_entities):
+                await send_queue.reply(message, "Please don't send links to other chats.")
+                return False
+
+            for url_entity, res in (await fetch_urls(url_entities)).items():
+                if isinstance(res, Exception):
+                    logging.error(res)
+                    continue
+                # a long article would crowd the rest of the conversation out of the context
+                message_text = message_text.replace(url_entity, '\n>>'+ truncate(res.text_content, PAGE_TOKENS))
 
  
-    await message.answer_chat_action(ChatActions.TYPING)
+    send_queue.chat_action(message, ChatActions.TYPING)
+    conversation.fold_passive(conversations.take_passive(message.chat.id))
     if message.reply_to_message:
         role = "assistant" if message.reply_to_message.from_user.is_bot else "user"
         conversation.append(role, message.reply_to_message.text)
-        mentioned = mentioned or role == "assistant"
 
     if message_text:
         conversation.append("user", message_text)
 
-    if not mentioned and not is_private:
-        return
+    return True
 
-    completion = await complete(model, conversation, model_switch_for_bigger_context = True) 
 
-    logging.debug(completion)
+async def answer_handler(message: types.Message, model: str = DEFAULT_MODEL):
+    try:
+        await respond(message, model)
+    except asyncio.CancelledError:
+        logging.info(f"Answer for {message.chat.id} superseded by a newer message")
+        raise
+    except Exception as e:
+        logging.error(e)
+        ERRORS.inc("answer")
+        await send_queue.answer(message, "Error occured. Please try again later.\n"+str(e))
 
-    answer = completion["choices"][0]["message"]["content"]
-    finish_reason = completion["choices"][0]["finish_reason"]
+        conversation = conversations[message.chat.id]
+        conversation.increase_error(model)
 
-    if finish_reason == "length":
-        answer += u"\u2026"
 
-    conversation.append("assistant", answer)
-    conversation.increase_message_usage (model= completion["model"], usage= completion["usage"])
+async def respond(message: types.Message, model=DEFAULT_MODEL):
+    conversation = conversations[message.chat.id]
+    await retrieve_passages(message.chat.id, conversation, model)
+
+    # the prompt is estimated locally, the request is refused before it costs anything
+    estimate = min(conversation.count_tokens(model), context_limit(model or engine)) + COMPLETION_RESERVE
+    reason = ledger.check(message.from_user.id, message.chat.id, tokens=estimate)
+    if reason:
+        await send_queue.answer(message, reason)
+        return
+
+    voice = VoiceReply(speaker, message) if conversation.voice_replies else None
+    try:
+        if conversation.streaming:
+            answer = await stream_answer(message, model, conversation, voice)
+        else:
+            answer = await complete_answer(message, model, conversation)
+            if voice is not None:
+                voice.feed(answer)
+    except BaseException:
+        if voice is not None:
+            voice.cancel()
+            record_speech(message, voice)
+        raise
 
     logging.debug(f"Assistant: {answer}")
 
@@ -259,16 +439,85 @@ async def text_handler(message: types.Message, model=DEFAULT_MODEL):
     if not suggestions or len(answer) <= 5:
         markup = ReplyKeyboardRemove()
     else:
-        await message.answer_chat_action(ChatActions.CHOOSE_STICKER)
-        completion = openai.ChatCompletion.create(
-            engine=engine,
-            model=model,
-            n=suggestions,
-            messages=[
-                {"role": "system", "content": "Generate a short followup question up to 10 tokens long"},
-                {"role": "user", "content": message.text},
-                {"role": "assistant", "content": answer}, ],
-        )
+        markup = None
+
+    if not conversation.streaming:
+        with STAGE_SECONDS.time("message_answer"):
+            await send_queue.answer(message, answer, parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
+
+    if voice is not None:
+        try:
+            await speak(voice)
+        finally:
+            record_speech(message, voice)
+
+    # suggestions are generated in the background and arrive as a follow-up message with the keyboard
+    if markup is None:
+        task = asyncio.create_task(send_suggestions(message, model, message.text, answer, suggestions))
+        pending_suggestions[message.chat.id] = task
+
+    summarizer.schedule(message.chat.id, model, message.from_user.id)
+
+
+async def retrieve_passages(chat_id: int, conversation, model):
+    """
+    Looks up the passages of the chat's documents relevant to the last message.
+    They are sent with the prompt but not kept in the history.
+    """
+    question = conversation.history[-1]["content"] if len(conversation.history) > 1 else ""
+    with STAGE_SECONDS.time("retrieve"):
+        passages = await documents.retrieve(chat_id, question, model=model) if question else []
+    if passages or conversation.passages is not None:
+        conversation.set_passages(passages)
+
+
+async def speak(voice: VoiceReply):
+    """
+    Waits for the voice clips of the answer, the text was already sent so a failure only loses the voice.
+    """
+    try:
+        await voice.finish()
+    except asyncio.CancelledError:
+        voice.cancel()
+        raise
+    except Exception as e:
+        logging.error(e)
+        ERRORS.inc("voice_reply")
+        voice.cancel()
+
+
+def record_speech(message: types.Message, voice: VoiceReply):
+    if voice.characters:
+        ledger.record(message.from_user.id, message.chat.id, speaker.backend.model,
+                      speech_characters=voice.characters)
+
+
+def cancel_suggestions(chat_id: int):
+    task = pending_suggestions.pop(chat_id, None)
+    if task is not None:
+        task.cancel()
+
+
+async def send_suggestions(message: types.Message, model, question: str, answer: str, suggestions: int):
+    """
+    Generates followup questions for the answer and sends them as a reply keyboard.
+    Runs as a background task, cancelled when the user sends a new message first.
+    """
+    try:
+        with STAGE_SECONDS.time("suggestions"):
+            completion = await pool.call(
+                openai.ChatCompletion.acreate,
+                model=model or engine,
+                priority=BACKGROUND,
+                tokens=count_tokens(question + answer, model) + 20 * suggestions,
+                n=suggestions,
+                messages=[
+                    {"role": "system", "content": "Generate a short followup question up to 10 tokens long"},
+                    {"role": "user", "content": question},
+                    {"role": "assistant", "content": answer}, ],
+            )
+        ledger.record(message.from_user.id, message.chat.id, completion["model"],
+                      completion["usage"]["prompt_tokens"], completion["usage"]["completion_tokens"])
         choices = [choice["message"]["content"] for choice in completion.choices]
 
         markup = ReplyKeyboardMarkup(resize_keyboard=False, one_time_keyboard=True)
@@ -278,48 +527,221 @@ async def text_handler(message: types.Message, model=DEFAULT_MODEL):
         buttons = [KeyboardButton(text=choice) for choice in choices]
         markup.add(*buttons)
 
+        await send_queue.answer(message, "Suggestions:", reply_markup=markup)
+    except asyncio.CancelledError:
+        logging.debug(f"Suggestions for {message.chat.id} cancelled")
+        raise
+    except Exception as e:
+        logging.error(e)
+        ERRORS.inc("suggestions")
+    finally:
+        if pending_suggestions.get(message.chat.id) is asyncio.current_task():
+            del pending_suggestions[message.chat.id]
+
+
+async def complete_answer(message: types.Message, model, conversation) -> str:
+    sent = []
     try:
-        await message.answer(answer, parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
-    except CantParseEntities as e:
-        logging.warning(e)
-        await message.answer(answer, reply_markup=markup)
+        completion = await complete(model, conversation, model_switch_for_bigger_context = True, on_sent=sent.append)
+    except asyncio.CancelledError:
+        # superseded by a newer message after the request went out, the completion is billed anyway
+        if sent:
+            spend_recorder(message, conversation, "cancelled")(sent[-1])
+        raise
 
+    logging.debug(completion)
 
-async def complete(model, conversation, model_switch_for_bigger_context=False):
+    answer = completion["choices"][0]["message"]["content"]
+    finish_reason = completion["choices"][0]["finish_reason"]
+
+    if finish_reason == "length":
+        answer += u"\u2026"
+
+    conversation.append("assistant", answer)
+    record_usage(message, conversation, completion["model"], completion["usage"])
+    return answer
+
+
+async def stream_answer(message: types.Message, model, conversation, voice: VoiceReply = None) -> str:
+    """
+    Streams the completion into the chat, editing a placeholder message as the tokens arrive.
+    The streamed response carries no usage, so it is estimated locally.
+    With voice the complete sentences are spoken while the rest is still generated.
+    An answer cancelled by a newer message keeps the text the user already saw, in the chat and in the history.
+    """
+    chunks = await complete(model, conversation, model_switch_for_bigger_context = True, stream = True,
+                            on_hedge_lost=spend_recorder(message, conversation, "hedge_lost"))
+    prompt_tokens = conversation.count_tokens(model)
+
+    # the keyboard of the previous suggestions goes away, new ones arrive with a keyboard of their own
+    reply = StreamingReply(message, reply_markup=ReplyKeyboardRemove())
+    completion_model = model
+    finish_reason = None
+    try:
+        await reply.start()
+        async for chunk in chunks:
+            completion_model = chunk.get("model") or completion_model
+            if not chunk["choices"]:
+                continue
+            choice = chunk["choices"][0]
+            delta = choice["delta"].get("content", "")
+            await reply.feed(delta)
+            if voice is not None and delta:
+                voice.feed(delta)
+            finish_reason = choice.get("finish_reason") or finish_reason
+
+        await reply.finish(u"\u2026" if finish_reason == "length" else "")
+    except asyncio.CancelledError:
+        # the tokens generated so far are billed, the newer message waits for the chat lock meanwhile
+        if reply.answer:
+            conversation.append("assistant", reply.answer + u"\u2026")
+        record_stream_usage(message, conversation, completion_model, prompt_tokens, reply.answer)
+        try:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+            await reply.abort()
+        except Exception as e:
+            logging.warning(f"Ending the cancelled answer failed: {e}")
+        raise
+    except Exception:
+        # the stream holds an in-flight slot of the scheduler until it is closed
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+        raise
+
+    answer = reply.answer
+    conversation.append("assistant", answer)
+    record_stream_usage(message, conversation, completion_model, prompt_tokens, answer)
+    return answer
+
+
+def record_stream_usage(message: types.Message, conversation, model: str, prompt_tokens: int, answer: str):
+    completion_tokens = count_tokens(answer, model)
+    record_usage(message, conversation, model, {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    })
+
+
+def spend_recorder(message: types.Message, conversation, kind: str):
+    """
+    Records the spend of requests whose answer is thrown away, e.g. the hedged requests that lost or the ones
+    cancelled by a newer message. Without a reported usage the prompt is estimated.
+    :param kind: the token metric label.
+    """
+    def record(model: str, usage: dict = None):
+        if usage is None:
+            usage = {"prompt_tokens": conversation.count_tokens(model), "completion_tokens": 0}
+        ledger.record(message.from_user.id, message.chat.id, model, usage["prompt_tokens"], usage["completion_tokens"])
+        TOKENS.inc(model, kind, amount=usage["prompt_tokens"] + usage["completion_tokens"])
+    return record
+
+
+def record_usage(message: types.Message, conversation, model: str, usage: dict):
+    conversation.increase_message_usage(model=model, usage=usage)
+    ledger.record(message.from_user.id, message.chat.id, model, usage["prompt_tokens"], usage["completion_tokens"])
+    TOKENS.inc(model, "prompt", amount=usage["prompt_tokens"])
+    TOKENS.inc(model, "completion", amount=usage["completion_tokens"])
+
+
+def budget(model, conversation, model_switch_for_bigger_context=False):
+    """
+    Picks the model and trims the conversation so the prompt and the completion reserve fit into the context window.
+    Done locally, before the request is sent, so a long conversation doesn't cost failed round trips.
+    :return: the model to send the request to.
+    """
+    prompt_tokens = conversation.count_tokens(model)
+    max_tokens = context_limit(model or engine) - COMPLETION_RESERVE
+    if prompt_tokens <= max_tokens:
+        return model
+
+    if model_switch_for_bigger_context and model and model == DEFAULT_MODEL and \
+            prompt_tokens <= context_limit(BIG_CONTEXT_MODEL) - COMPLETION_RESERVE:
+        logging.info(f"Switching to {BIG_CONTEXT_MODEL} for {prompt_tokens} prompt tokens")
+        CONTEXT_FALLBACKS.inc("switch_model")
+        return BIG_CONTEXT_MODEL
+
+    CONTEXT_FALLBACKS.inc("prune")
+    if not conversation.prune(prompt_tokens, max_tokens, model):
+        logging.warning(f"Conversation doesn't fit into {max_tokens} tokens even after pruning")
+    return model
+
+
+async def complete(model, conversation, model_switch_for_bigger_context=False, stream=False, retry=True,
+                   on_hedge_lost=None, on_sent=None):
     from openai.error import InvalidRequestError, RateLimitError
 
+    model = budget(model, conversation, model_switch_for_bigger_context)
+
     try:
-        completion = await openai.ChatCompletion.acreate(
-            engine=engine,
-            model=model,
-            messages=conversation.history
-        )
+        with STAGE_SECONDS.time("complete"):
+            completion = await pool.call(
+                openai.ChatCompletion.acreate,
+                model=model or engine,
+                priority=INTERACTIVE,
+                tokens=conversation.count_tokens(model) + COMPLETION_RESERVE,
+                reserve=COMPLETION_RESERVE,
+                # only the time to the first token is predictable enough to hedge on
+                hedge=stream,
+                on_hedge_lost=on_hedge_lost,
+                on_sent=on_sent,
+                messages=conversation.prompt(),
+                stream=stream,
+            )
     except InvalidRequestError as e:
         user_message = e.user_message
 
-        # parse message using regex to get the number of tokens
+        # the local count is an estimate, if it was off fall back to the numbers reported by the API
         #  "This model's maximum context length is 4097 tokens. However, your messages resulted in 7894 tokens. Please reduce the length of the messages."
         match = re.search(r"maximum context length is (\d+) tokens. However, your messages resulted in (\d+) tokens", user_message)
-        if not match:
+        if not match or not retry:
             raise e
         
         max_tokens = int(match.group(1))
         message_tokens = int(match.group(2))
-        
-        if model_switch_for_bigger_context and model == DEFAULT_MODEL and message_tokens < 16000:
-            return await complete("gpt-3.5-turbo-16k", conversation, model_switch_for_bigger_context=False)
 
-        if not conversation.prune(message_tokens, max_tokens):
+        if not conversation.prune(message_tokens, max_tokens - COMPLETION_RESERVE, model):
             raise e
         
-        # Retry if conversation is pruned
-        return await complete(model, conversation)
+        # Retry once if conversation is pruned
+        CONTEXT_FALLBACKS.inc("api_error")
+        return await complete(model, conversation, stream=stream, retry=False, on_hedge_lost=on_hedge_lost,
+                              on_sent=on_sent)
     
     except RateLimitError as e:
+        # the pool already failed over and retried
         raise e
         
     return completion
 
 
+def pending_tasks() -> list:
+    """
+    Returns the answers, suggestions and summaries still running, shutdown waits for them.
+    """
+    return chat_actors.pending() + [task for task in pending_suggestions.values() if not task.done()] + \
+        [task for task in summarizer.tasks.values() if not task.done()]
+
+
+async def on_startup(dispatcher: Dispatcher):
+    await metrics.start_server()
+    conversations.start()
+    ledger.start()
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    await metrics.stop_server()
+    await close_session()
+    voice_pipeline.close()
+    await speaker.close()
+    await summarizer.close()
+    documents.close()
+    await conversations.close()
+    await ledger.close()
+
+
 if __name__ == '__main__':
-    executor.start_polling(dp)
+    # start_polling only runs on_shutdown for SystemExit and KeyboardInterrupt, a plain SIGTERM would skip it
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from aiogram import types
+from aiogram.types import ParseMode
+from aiogram.utils.exceptions import CantParseEntities, MessageNotModified, RetryAfter
+
+from metrics import Counter
+from misc.middleware.throttling import bucket_backend, BUCKET_SHARE
+from text_utils import is_valid_markdown
+
+# Outbound queue
+#
+# Everything the bot sends goes through one queue per chat, so the messages of a chat keep their order,
+# and every request takes a token from the chat's bucket and the global one, so a busy moment is smoothed
+# out instead of running into Telegram's flood limits. A RetryAfter is waited out and the request retried.
+# Chat actions are collapsed: a newer action replaces a queued one, a queued message drops a queued action
+# (the message ends it anyway) and an action repeated while it is still shown is not sent again.
+# Progress edits (edit_later) don't wait: a queued edit of the same message only takes the newer text, so a
+# streamed answer isn't held up by the chat's bucket and the latest text is sent when a token is available.
+
+# requests per second over all chats, Telegram allows about 30; the chats of one process only need its share
+SEND_RATE = float(os.getenv("SEND_RATE", 30)) * BUCKET_SHARE
+SEND_BURST = max(1, int(int(os.getenv("SEND_BURST", 30)) * BUCKET_SHARE))
+# messages per second to one private chat
+PRIVATE_RATE = 1.0
+PRIVATE_BURST = 3
+# messages per second to one group, Telegram allows 20 per minute
+GROUP_RATE = 20 / 60
+GROUP_BURST = 5
+# Telegram shows a chat action for 5 seconds or until the next message
+ACTION_SECONDS = 4.5
+MAX_SEND_RETRIES = 5
+# idle chats are forgotten once there are more than this many
+MAX_CHATS = 10000
+
+SEND_RETRIES = Counter("bot_telegram_retries_total", "Telegram requests retried after a flood wait", ["kind"])
+
+
+class ChatOutbox():
+    __slots__ = ("queue", "group", "last_action", "last_action_time", "worker")
+
+    def __init__(self, group: bool):
+        self.queue = deque()  # [factory, future] of the messages, [(message, action), None] of the chat actions
+        self.group = group
+        self.last_action = None
+        self.last_action_time = 0.0
+        self.worker = None
+
+
+class SendQueue():
+    """
+    Sends the requests of every chat in order, within the per chat and global rate limits.
+    """
+
+    def __init__(self):
+        self.buckets = bucket_backend("send:")
+        self.chats = {}
+        self.edits = {}  # (chat_id, message_id) -> [text, parse_mode, kwargs] of the queued progress edit
+
+    def _outbox(self, chat: types.Chat) -> ChatOutbox:
+        outbox = self.chats.get(chat.id)
+        if outbox is None:
+            if len(self.chats) >= MAX_CHATS:
+                self._sweep()
+            outbox = self.chats[chat.id] = ChatOutbox(chat.type != types.ChatType.PRIVATE)
+        return outbox
+
+    def _sweep(self):
+        now = time.monotonic()
+        for chat_id, outbox in list(self.chats.items()):
+            if outbox.worker is None and not outbox.queue and now - outbox.last_action_time >= ACTION_SECONDS:
+                del self.chats[chat_id]
+
+    def _wake(self, chat_id: int, outbox: ChatOutbox):
+        if outbox.worker is None:
+            outbox.worker = asyncio.ensure_future(self._run(chat_id, outbox))
+
+    def queued(self) -> int:
+        return sum(len(outbox.queue) for outbox in self.chats.values())
+
+    def _enqueue(self, chat: types.Chat, factory) -> asyncio.Future:
+        outbox = self._outbox(chat)
+        if outbox.queue and outbox.queue[-1][1] is None:
+            outbox.queue.pop()
+
+        future = asyncio.get_running_loop().create_future()
+        outbox.queue.append([factory, future])
+        self._wake(chat.id, outbox)
+        return future
+
+    async def send(self, chat: types.Chat, factory):
+        """
+        Queues a request to the chat.
+        :param factory: a function returning the coroutine that sends the request, called again for a retry.
+        :return: the result of the request.
+        """
+        return await self._enqueue(chat, factory)
+
+    def chat_action(self, message: types.Message, action: str):
+        """
+        Queues a chat action, doesn't wait for it.
+        """
+        outbox = self._outbox(message.chat)
+        if outbox.queue and outbox.queue[-1][1] is None:
+            outbox.queue[-1][0] = (message, action)
+            return
+        if not outbox.queue and outbox.last_action == action and \
+                time.monotonic() - outbox.last_action_time < ACTION_SECONDS:
+            return
+
+        outbox.queue.append([(message, action), None])
+        self._wake(message.chat.id, outbox)
+
+    async def _take(self, key: str, rate: float, burst: int):
+        while True:
+            allowed, wait, _ = await self.buckets.consume(key, rate, burst)
+            if allowed:
+                return
+            await asyncio.sleep(wait)
+
+    async def _call(self, factory, kind: str):
+        for attempt in range(MAX_SEND_RETRIES + 1):
+            try:
+                return await factory()
+            except RetryAfter as e:
+                if attempt == MAX_SEND_RETRIES:
+                    raise
+                logging.warning(f"Flood wait of {e.timeout}s sending a {kind}")
+                SEND_RETRIES.inc(kind)
+                await asyncio.sleep(e.timeout)
+
+    async def _run(self, chat_id: int, outbox: ChatOutbox):
+        try:
+            while outbox.queue:
+                item, future = outbox.queue.popleft()
+
+                if future is None:
+                    message, action = item
+                    await self._take("send:global", SEND_RATE, SEND_BURST)
+                    try:
+                        await self._call(lambda: message.answer_chat_action(action), "chat_action")
+                    except Exception as e:
+                        logging.warning(f"Chat action failed: {e}")
+                    outbox.last_action = action
+                    outbox.last_action_time = time.monotonic()
+                    continue
+
+                if future.done():
+                    # the caller gave up
+                    continue
+
+                if outbox.group:
+                    await self._take(f"send:{chat_id}", GROUP_RATE, GROUP_BURST)
+                else:
+                    await self._take(f"send:{chat_id}", PRIVATE_RATE, PRIVATE_BURST)
+                await self._take("send:global", SEND_RATE, SEND_BURST)
+
+                try:
+                    result = await self._call(item, "message")
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                # a message ends the chat action
+                outbox.last_action = None
+        finally:
+            outbox.worker = None
+
+    # helpers for the requests the handlers send
+
+    @staticmethod
+    def _text_factory(send, text: str, parse_mode):
+        """
+        Markdown that wouldn't parse is sent as plain text instead of failing and being sent twice.
+        """
+        if parse_mode == ParseMode.MARKDOWN and not is_valid_markdown(text):
+            parse_mode = None
+
+        async def factory():
+            try:
+                return await send(parse_mode)
+            except CantParseEntities as e:
+                if parse_mode is None:
+                    raise
+                logging.warning(e)
+                return await send(None)
+
+        return factory
+
+    async def _text(self, chat: types.Chat, send, text: str, parse_mode):
+        return await self.send(chat, self._text_factory(send, text, parse_mode))
+
+    async def answer(self, message: types.Message, text: str, parse_mode=None, **kwargs) -> types.Message:
+        return await self._text(message.chat, lambda mode: message.answer(text, parse_mode=mode, **kwargs), text,
+                                parse_mode)
+
+    async def reply(self, message: types.Message, text: str, parse_mode=None, **kwargs) -> types.Message:
+        return await self._text(message.chat, lambda mode: message.reply(text, parse_mode=mode, **kwargs), text,
+                                parse_mode)
+
+    async def edit(self, message: types.Message, text: str, parse_mode=None, **kwargs):
+        # a queued progress edit of the message is superseded
+        self.edits.pop((message.chat.id, message.message_id), None)
+        return await self._text(message.chat, lambda mode: message.edit_text(text, parse_mode=mode, **kwargs), text,
+                                parse_mode)
+
+    def edit_later(self, message: types.Message, text: str, parse_mode=None, **kwargs):
+        """
+        Queues a progress edit without waiting for it. If an edit of the message is already queued,
+        it sends this text instead. Failures are only logged.
+        """
+        key = (message.chat.id, message.message_id)
+        queued = key in self.edits
+        self.edits[key] = [text, parse_mode, kwargs]
+        if queued:
+            return
+
+        taken = []
+
+        async def factory():
+            # the text is taken when the edit is sent, a retry sends the same one
+            if not taken:
+                edit = self.edits.pop(key, None)
+                if edit is None:
+                    return None
+                text, parse_mode, kwargs = edit
+                taken.append(self._text_factory(
+                    lambda mode: message.edit_text(text, parse_mode=mode, **kwargs), text, parse_mode))
+            return await taken[0]()
+
+        self._enqueue(message.chat, factory).add_done_callback(_log_edit_failure)
+
+
+def _log_edit_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None and \
+            not isinstance(future.exception(), MessageNotModified):
+        logging.warning(f"Progress edit failed: {future.exception()}")
+
+
+send_queue = SendQueue()
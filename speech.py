@@ -0,0 +1,342 @@
+import asyncio
+import hashlib
+import io
+import os
+import re
+import shlex
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import openai
+from aiogram import types
+from aiogram.types import ChatActions
+
+from metrics import STAGE_SECONDS
+from backends import pool
+from openai_scheduler import INTERACTIVE
+from send_queue import send_queue
+
+# Voice replies
+#
+# The answer is cut into sentences while it is streamed, every sentence is synthesized as soon as it is
+# complete and the clips are sent in order as telegram voice messages, so the first sentence is heard
+# while the rest of the answer is still generated. Clips are cached on disk by the hash of their text.
+
+TTS_BACKEND = os.getenv("TTS_BACKEND", "openai")  # "openai" or "command"
+TTS_MODEL = os.getenv("TTS_MODEL", "tts-1")
+TTS_VOICE = os.getenv("TTS_VOICE", "alloy")
+# a local synthesizer that reads the text on stdin and writes a wav file to stdout
+TTS_COMMAND = os.getenv("TTS_COMMAND", "espeak-ng --stdin --stdout")
+TTS_TIMEOUT = 60  # seconds
+# sentences synthesized at the same time for one answer
+TTS_PARALLELISM = int(os.getenv("TTS_PARALLELISM", 3))
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_FILES = int(os.getenv("TTS_CACHE_FILES", 5000))
+# short sentences are merged into one clip, long ones are cut
+SEGMENT_MIN_CHARS = 80
+SEGMENT_MAX_CHARS = 1000
+
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+MARKDOWN = re.compile(r"[*_`#>|~]+")
+
+
+def take_segments(text: str, final: bool = False):
+    """
+    Splits the complete sentences off the text.
+    Sentences are merged until a segment has SEGMENT_MIN_CHARS characters.
+
+    :param final: the text is complete, the last sentence doesn't need a terminator.
+    :return: a tuple (list of segments, remaining text).
+    """
+    segments = []
+    start = 0
+    segment_start = 0
+    for match in SENTENCE_END.finditer(text):
+        start = match.end()
+        if start - segment_start >= SEGMENT_MIN_CHARS:
+            segments.append(text[segment_start:start])
+            segment_start = start
+
+    rest = text[segment_start:]
+    if final and rest.strip():
+        segments.append(rest)
+        rest = ""
+
+    spoken = []
+    for segment in segments:
+        segment = " ".join(MARKDOWN.sub(" ", segment).split())
+        while len(segment) > SEGMENT_MAX_CHARS:
+            cut = segment.rfind(" ", 0, SEGMENT_MAX_CHARS)
+            cut = cut if cut > 0 else SEGMENT_MAX_CHARS
+            spoken.append(segment[:cut])
+            segment = segment[cut:].strip()
+        if segment:
+            spoken.append(segment)
+    return spoken, rest
+
+
+def encode_ogg(data: bytes) -> bytes:
+    """
+    Encodes audio to OGG/Opus, the format telegram plays as a voice message. Runs in a worker process.
+    """
+    from pydub import AudioSegment
+    out = io.BytesIO()
+    AudioSegment.from_file(io.BytesIO(data)).export(out, format="ogg", codec="libopus")
+    return out.getvalue()
+
+
+class OpenAISpeech():
+    """
+    Synthesizes with the OpenAI speech endpoint, which returns OGG/Opus as is.
+    Requests go through the backend pool, so they fail over like the completions; on Azure the model needs
+    a deployment in OPENAI_BACKENDS.
+    """
+    format = "ogg"
+
+    def __init__(self, model: str = TTS_MODEL, voice: str = TTS_VOICE):
+        self.model = model
+        self.voice = voice
+        self.name = f"openai:{model}:{voice}"
+        self.session = None
+
+    async def _request(self, text: str, model: str, api_key: str = None, api_base: str = None, api_type: str = None,
+                       api_version: str = None, engine: str = None) -> bytes:
+        """
+        Posts the text to the backend chosen by the pool, the arguments after the text are the pool's.
+        """
+        from openai.error import APIError, RateLimitError
+
+        if self.session is None:
+            import aiohttp
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=TTS_TIMEOUT))
+
+        api_base = (api_base or openai.api_base).rstrip("/")
+        api_key = api_key or openai.api_key
+        if (api_type or openai.api_type or "").startswith("azure"):
+            url = f"{api_base}/openai/deployments/{engine}/audio/speech?api-version={api_version or openai.api_version}"
+            headers = {"api-key": api_key}
+        else:
+            url = api_base + "/audio/speech"
+            headers = {"Authorization": f"Bearer {api_key}"}
+
+        async with self.session.post(url, headers=headers,
+                                     json={"model": model, "voice": self.voice, "input": text,
+                                           "response_format": "opus"}) as response:
+            body = await response.read()
+            # the headers are passed as they are, case insensitive, the scheduler looks up retry-after
+            if response.status == 429:
+                raise RateLimitError(body.decode(errors="replace"), http_status=429, headers=response.headers)
+            if response.status != 200:
+                raise APIError(body.decode(errors="replace"), http_status=response.status, headers=response.headers)
+            return body
+
+    async def synthesize(self, text: str) -> bytes:
+        return await pool.call(self._request, text, model=self.model, priority=INTERACTIVE)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class CommandSpeech():
+    """
+    Synthesizes with a local program, e.g. espeak-ng, its output is encoded to OGG/Opus.
+    """
+    format = "wav"
+    model = "command"
+
+    def __init__(self, command: str = TTS_COMMAND):
+        self.command = shlex.split(command)
+        self.name = "command:" + command
+
+    async def synthesize(self, text: str) -> bytes:
+        process = await asyncio.create_subprocess_exec(*self.command, stdin=asyncio.subprocess.PIPE,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.DEVNULL)
+        try:
+            audio, _ = await asyncio.wait_for(process.communicate(text.encode()), TTS_TIMEOUT)
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+            raise
+        if process.returncode != 0:
+            raise Exception(f"{self.command[0]} exited with {process.returncode}")
+        return audio
+
+    async def close(self):
+        pass
+
+
+BACKENDS = {"openai": OpenAISpeech, "command": CommandSpeech}
+
+
+class ClipCache():
+    """
+    Synthesized clips on disk, addressed by the hash of the backend and the text.
+    The least recently used clips are removed once there are more than max_files.
+    The methods do blocking file I/O, the Speaker calls them in a thread.
+    """
+
+    def __init__(self, directory: str = TTS_CACHE_DIR, max_files: int = TTS_CACHE_FILES):
+        self.directory = directory
+        self.max_files = max_files
+        self.writes = 0
+        self.lock = threading.Lock()  # guards writes, puts run in parallel threads
+
+    def path(self, backend: str, text: str) -> str:
+        key = hashlib.sha256(f"{backend}\n{text}".encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], key + ".ogg")
+
+    def get(self, backend: str, text: str):
+        path = self.path(backend, text)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # missing, or trimmed meanwhile
+            return None
+        return data
+
+    def put(self, backend: str, text: str, data: bytes):
+        path = self.path(backend, text)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # puts run in parallel threads, each writes a file of its own
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(data)
+        os.replace(temporary, path)
+
+        with self.lock:
+            self.writes += 1
+            trim = self.writes % 100 == 0
+        if trim:
+            self.trim()
+
+    def trim(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            files.extend(os.path.join(root, name) for name in names if name.endswith(".ogg"))
+        if len(files) <= self.max_files:
+            return
+        times = []
+        for path in files:
+            try:
+                times.append((os.stat(path).st_mtime, path))
+            except FileNotFoundError:
+                pass
+        times.sort()
+        for _, path in times[:len(times) - self.max_files]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class Speaker():
+    """
+    Turns text into voice clips: cache, synthesis and encoding.
+    """
+
+    def __init__(self, backend=None, cache: ClipCache = None, parallelism: int = TTS_PARALLELISM):
+        self.backend = backend if backend is not None else BACKENDS[TTS_BACKEND]()
+        self.cache = cache if cache is not None else ClipCache()
+        self.parallelism = parallelism
+        self.executor = None
+
+    async def clip(self, text: str):
+        """
+        :return: a tuple (OGG/Opus clip, True if it was synthesized rather than taken from the cache).
+        """
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self.cache.get, self.backend.name, text)
+        if data is not None:
+            return data, False
+
+        with STAGE_SECONDS.time("tts_synthesize"):
+            data = await self.backend.synthesize(text)
+        if self.backend.format != "ogg":
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=1)
+            with STAGE_SECONDS.time("tts_encode"):
+                data = await loop.run_in_executor(self.executor, encode_ogg, data)
+
+        await loop.run_in_executor(None, self.cache.put, self.backend.name, text, data)
+        return data, True
+
+    async def close(self):
+        await self.backend.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+class VoiceReply():
+    """
+    Speaks an answer while it is generated: complete sentences are synthesized concurrently,
+    at most `parallelism` at a time, and the clips are sent in the order of the text.
+    `characters` counts the characters synthesized, the cached clips cost nothing.
+    """
+
+    def __init__(self, speaker: Speaker, message: types.Message):
+        self.speaker = speaker
+        self.message = message
+        self.text = ""
+        self.slots = asyncio.Semaphore(speaker.parallelism)
+        self.clips = asyncio.Queue()
+        self.tasks = []
+        self.sender = None
+        self.characters = 0
+
+    async def _clip(self, text: str) -> bytes:
+        async with self.slots:
+            clip, synthesized = await self.speaker.clip(text)
+        if synthesized:
+            self.characters += len(text)
+        return clip
+
+    def _queue(self, segments):
+        for segment in segments:
+            task = asyncio.ensure_future(self._clip(segment))
+            self.tasks.append(task)
+            self.clips.put_nowait(task)
+        if segments and self.sender is None:
+            self.sender = asyncio.ensure_future(self._send())
+
+    async def _send(self):
+        started = time.monotonic()
+        first = True
+        while True:
+            task = await self.clips.get()
+            if task is None:
+                return
+            if not task.done():
+                send_queue.chat_action(self.message, ChatActions.RECORD_VOICE)
+            clip = await task
+            if first:
+                STAGE_SECONDS.observe(time.monotonic() - started, "tts_first_clip")
+                first = False
+            # a retry needs a fresh file
+            await send_queue.send(self.message.chat, lambda: self.message.answer_voice(
+                types.InputFile(io.BytesIO(clip), filename="answer.ogg")))
+
+    def feed(self, delta: str):
+        self.text += delta
+        segments, self.text = take_segments(self.text)
+        self._queue(segments)
+
+    async def finish(self):
+        """
+        Speaks the rest of the text and waits until all the clips are sent.
+        """
+        segments, self.text = take_segments(self.text, final=True)
+        self._queue(segments)
+        if self.sender is not None:
+            self.clips.put_nowait(None)
+            await self.sender
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.sender is not None:
+            self.sender.cancel()
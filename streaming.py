@@ -0,0 +1,132 @@
+import time
+
+from aiogram import types
+from aiogram.types import ParseMode
+from aiogram.utils.exceptions import MessageNotModified
+
+from metrics import STAGE_SECONDS
+from send_queue import send_queue
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+# Telegram allows roughly one edit per second per chat, stay a little below
+STREAM_EDIT_INTERVAL = 1.2
+# don't bother editing for a handful of new characters
+STREAM_EDIT_MIN_CHARS = 40
+PLACEHOLDER = u"…"
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH):
+    """
+    Splits text into a head that fits into a single Telegram message and the remaining tail.
+    Prefers to split on a paragraph or line break, then on a space.
+
+    :param text: the text to split.
+    :param limit: maximum length of the head.
+    :return: a tuple (head, tail).
+    """
+    if len(text) <= limit:
+        return text, ""
+
+    for separator in ("\n\n", "\n", " "):
+        index = text.rfind(separator, 0, limit)
+        if index > limit // 2:
+            return text[:index], text[index + len(separator):]
+
+    return text[:limit], text[limit:]
+
+
+class StreamingReply():
+    """
+    Posts a placeholder message and progressively edits it while the completion is streamed.
+    Edits are coalesced: a new edit is only sent when at least `min_interval` seconds passed and
+    at least `min_delta` characters were added since the previous one.
+    Text that doesn't fit into one message rolls over into follow-up messages.
+    """
+
+    def __init__(self, message: types.Message, min_interval: float = STREAM_EDIT_INTERVAL,
+                 min_delta: int = STREAM_EDIT_MIN_CHARS, reply_markup=None):
+        """
+        :param reply_markup: sent with the first message, edits can't change a reply keyboard.
+        """
+        self.message = message
+        self.reply_markup = reply_markup
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+
+        self.answer = ""        # the whole answer streamed so far
+        self.text = ""          # the part of the answer that belongs to the current telegram message
+        self.sent = None        # the current telegram message
+        self.sent_text = ""     # the text the current telegram message shows
+        self.last_edit = 0
+
+    async def start(self):
+        with STAGE_SECONDS.time("message_answer"):
+            self.sent = await send_queue.answer(self.message, PLACEHOLDER, reply_markup=self.reply_markup)
+        self.reply_markup = None
+        self.sent_text = PLACEHOLDER
+        self.last_edit = time.monotonic()
+
+    async def feed(self, delta: str):
+        if not delta:
+            return
+
+        self.answer += delta
+        self.text += delta
+
+        # the message in progress shows the placeholder after the text
+        while len(self.text) > MAX_MESSAGE_LENGTH - len(PLACEHOLDER):
+            head, self.text = split_message(self.text, MAX_MESSAGE_LENGTH - len(PLACEHOLDER))
+            await self._finalize(head)
+            await self.start()
+
+        if len(self.text) - len(self.sent_text) < self.min_delta:
+            return
+        if time.monotonic() - self.last_edit < self.min_interval:
+            return
+
+        # doesn't wait for the chat's rate limit, the stream keeps being read
+        send_queue.edit_later(self.sent, self.text + PLACEHOLDER, disable_web_page_preview=True)
+        self.sent_text = self.text + PLACEHOLDER
+        self.last_edit = time.monotonic()
+
+    async def finish(self, suffix: str = ""):
+        """
+        Flushes the remaining text and renders the last message as markdown.
+
+        :param suffix: text appended to the end of the answer, e.g. an ellipsis for truncated answers.
+        """
+        self.answer += suffix
+        self.text += suffix
+        while len(self.text) > MAX_MESSAGE_LENGTH:
+            head, self.text = split_message(self.text)
+            await self._finalize(head)
+            await self.start()
+        await self._finalize(self.text or PLACEHOLDER)
+
+    async def abort(self):
+        """
+        Ends the reply when the answer is cancelled: the text streamed so far stays, without the placeholder,
+        a reply with no text yet is deleted.
+        """
+        if self.sent is None:
+            return
+        if self.text:
+            await self._finalize(self.text)
+        else:
+            await send_queue.send(self.message.chat, self.sent.delete)
+
+    async def _edit(self, text: str, parse_mode=None):
+        if text == self.sent_text and parse_mode is None:
+            return
+        try:
+            with STAGE_SECONDS.time("message_edit"):
+                await send_queue.edit(self.sent, text, parse_mode=parse_mode, disable_web_page_preview=True)
+        except MessageNotModified:
+            pass
+        self.sent_text = text
+        self.last_edit = time.monotonic()
+
+    async def _finalize(self, text: str):
+        # the send queue falls back to plain text if the markdown doesn't parse
+        await self._edit(text, parse_mode=ParseMode.MARKDOWN)
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import os
+
+import openai
+
+from api_key import engine
+from backends import pool
+from metrics import STAGE_SECONDS, TOKENS
+from openai_scheduler import BACKGROUND
+from tokens import count_tokens
+
+# Rolling summary
+#
+# Messages that drop out of the history (trimmed, pruned or wiped after the idle timeout) are folded into
+# a running summary that is sent right after the system message. Folding runs in the background after the
+# answer was sent and only feeds the new messages and the previous summary to the model, so the prompt of
+# a turn stays about the same size however long the conversation gets.
+
+# fold once this many messages were evicted, one request covers a few turns
+SUMMARY_BATCH = int(os.getenv("SUMMARY_BATCH", 4))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 300))
+# long messages (e.g. fetched articles) are cut before they are summarized
+SUMMARY_INPUT_CHARS = 2000
+
+SUMMARY_INSTRUCTIONS = ("You maintain a short running summary of a conversation between a user and an assistant. "
+                        "Update the summary with the new messages. Keep names, facts, numbers, decisions and open "
+                        "questions, drop small talk. Reply with the updated summary only.")
+
+
+def summary_prompt(summary: str, messages: list) -> list:
+    lines = []
+    for message in messages:
+        content = message["content"]
+        if len(content) > SUMMARY_INPUT_CHARS:
+            content = content[:SUMMARY_INPUT_CHARS] + u"…"
+        lines.append(f"{message['role']}: {content}")
+
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": f"Current summary:\n{summary or '(empty)'}\n\nNew messages:\n" + "\n".join(lines)},
+    ]
+
+
+class Summarizer():
+    """
+    Folds the evicted messages of the conversations into their summaries, at most one request per chat at a time.
+    """
+
+    def __init__(self, conversations, ledger=None):
+        self.conversations = conversations
+        self.ledger = ledger
+        self.tasks = {}
+
+    def schedule(self, chat_id: int, model: str, user_id: int):
+        """
+        Starts folding the evicted messages of the chat if enough of them piled up.
+        :param user_id: the user the spend is recorded for, the one whose message was just answered.
+        """
+        conversation = self.conversations[chat_id]
+        if chat_id in self.tasks or len(conversation.evicted) < SUMMARY_BATCH:
+            return
+
+        # pinned, so the summary isn't folded into a copy that was spilled meanwhile
+        self.conversations.pin(chat_id)
+        task = asyncio.create_task(self._fold(chat_id, user_id, model, list(conversation.evicted),
+                                              conversation.summary_text()))
+        self.tasks[chat_id] = task
+        task.add_done_callback(lambda _: self._done(chat_id))
+
+    def _done(self, chat_id: int):
+        self.tasks.pop(chat_id, None)
+        self.conversations.unpin(chat_id)
+
+    async def _fold(self, chat_id: int, user_id: int, model: str, messages: list, summary: str):
+        prompt = summary_prompt(summary, messages)
+        try:
+            with STAGE_SECONDS.time("summarize"):
+                completion = await pool.call(
+                    openai.ChatCompletion.acreate,
+                    model=model or engine,
+                    priority=BACKGROUND,
+                    tokens=sum(count_tokens(m["content"], model) for m in prompt) + SUMMARY_MAX_TOKENS,
+                    max_tokens=SUMMARY_MAX_TOKENS,
+                    messages=prompt,
+                )
+            TOKENS.inc(completion["model"], "summary", amount=completion["usage"]["total_tokens"])
+            if self.ledger is not None:
+                self.ledger.record(user_id, chat_id, completion["model"], completion["usage"]["prompt_tokens"],
+                                   completion["usage"]["completion_tokens"])
+
+            if not self.conversations[chat_id].fold_summary(completion["choices"][0]["message"]["content"].strip(), messages):
+                logging.debug(f"Summary of {chat_id} is stale, dropped")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Summarizing {chat_id} failed: {e}")
+
+    async def close(self):
+        """
+        Cancels the running summaries and waits for them, so they unpin their conversations before the store closes.
+        """
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,10 +1,66 @@
-from typing import Dict, Set
-from collections import defaultdict
+import asyncio
+import ipaddress
+import os
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from typing import Dict, Set, Union
+from collections import defaultdict, OrderedDict
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+from metrics import STAGE_SECONDS
 
 def is_markdown(text: str):
     return text.startswith("*") and text.endswith("*")
 
 
+def is_valid_markdown(text: str) -> bool:
+    """
+    Checks that Telegram will parse the text as legacy Markdown: code blocks, inline code, *bold* and _italic_
+    are closed and links are complete. Entities don't nest, so inside one the other markers are plain text.
+    """
+    index = 0
+    entity = None
+    while index < len(text):
+        if entity is None and text.startswith("```", index):
+            end = text.find("```", index + 3)
+            if end < 0:
+                return False
+            index = end + 3
+            continue
+
+        char = text[index]
+        if entity is None and char == "\\" and text[index + 1:index + 2] in ("_", "*", "`", "["):
+            index += 2
+            continue
+        if entity is None and char == "`":
+            end = text.find("`", index + 1)
+            if end < 0:
+                return False
+            index = end + 1
+            continue
+        if entity is None and char == "[":
+            close = text.find("](", index + 1)
+            if close < 0 or text.find(")", close + 2) < 0:
+                return False
+            index = text.find(")", close + 2) + 1
+            continue
+
+        if char in "*_":
+            if entity is None:
+                entity = char
+            elif entity == char:
+                entity = None
+        index += 1
+    return entity is None
+
+
+def estimate_tokens(text: str) -> int:
+    # rough estimate, ~4 characters per token for english text
+    return len(text) // 4 + 1
+
+
 def entities_extract(message_text:str, entities) -> Dict[str, Set[str]]:
     d = defaultdict(set)
     for entity in entities:
@@ -22,16 +78,347 @@ class ReaderResult:
         self.site_name = site_name
         self.language = language
 
-def fetch_url(url:str)->ReaderResult:
-    import requests
+# "remote" posts the url to the reader service, "local" downloads and extracts the page in process
+READER_BACKEND = os.getenv("READER_BACKEND", "remote")
+READER_URL = os.getenv("READER_URL", "https://reader-mauve-three.vercel.app/api/extract")
+# the local reader stops reading a page after this many bytes
+MAX_PAGE_BYTES = int(os.getenv("MAX_PAGE_BYTES", 2 * 1024 * 1024))
+READ_CHUNK_BYTES = 64 * 1024
+# processes parsing the pages of the local reader, a big page takes a second or more
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", 1))
+MAX_REDIRECTS = 5
+REDIRECTS = (301, 302, 303, 307, 308)
+# tokens of a page pasted into the conversation
+PAGE_TOKENS = int(os.getenv("PAGE_TOKENS", 1500))
+FETCH_TIMEOUT = 15  # seconds
+FETCH_CONNECTIONS = 32
+FETCH_CACHE_SIZE = 256
+FETCH_CACHE_TTL = 60 * 60  # seconds
+
+
+class TTLCache():
+    """
+    A bounded LRU cache whose entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class ArticleParser(HTMLParser):
+    """
+    Collects the readable text of a html page and its metadata.
+    Text inside <article> or <main> wins over the rest of the page, navigation and scripts are skipped.
+    Runs in a worker process, see extract_page.
+    """
+    SKIP = {"script", "style", "noscript", "nav", "header", "footer", "aside", "form", "svg", "iframe", "button",
+            "template"}
+    BLOCKS = {"p", "div", "section", "li", "pre", "blockquote", "h1", "h2", "h3", "h4", "h5", "h6", "tr", "br",
+              "article", "main", "table", "dd", "dt", "figcaption"}
+    VOID = {"br", "img", "meta", "link", "input", "hr", "source", "wbr", "area", "base", "col", "embed", "track"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.skip = 0
+        self.main = 0
+        self.in_title = False
+        self.title = ""
+        self.meta = {}
+        self.language = None
+        self.blocks = []        # paragraphs of the whole page
+        self.main_blocks = []   # paragraphs inside <article>/<main>
+        self.current = []
+
+    def _flush(self):
+        text = " ".join("".join(self.current).split())
+        self.current = []
+        if text:
+            self.blocks.append(text)
+            if self.main:
+                self.main_blocks.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "html":
+            self.language = dict(attrs).get("lang")
+        elif tag == "title":
+            self.in_title = True
+        elif tag == "meta":
+            attrs = dict(attrs)
+            name = (attrs.get("property") or attrs.get("name") or "").lower()
+            if name and attrs.get("content"):
+                self.meta.setdefault(name, attrs["content"])
+
+        if tag in self.SKIP:
+            self.skip += 1
+        elif tag in self.BLOCKS:
+            self._flush()
+            if tag in ("article", "main"):
+                self.main += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.VOID:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self.in_title = False
+        elif tag in self.SKIP:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self.BLOCKS:
+            self._flush()
+            if tag in ("article", "main"):
+                self.main = max(self.main - 1, 0)
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+        elif not self.skip:
+            self.current.append(data)
+
+    def result(self) -> ReaderResult:
+        self._flush()
+        text = "\n\n".join(self.main_blocks or self.blocks)
+        meta = self.meta
+        return ReaderResult("article", text,
+                            meta.get("og:title") or " ".join(self.title.split()) or None,
+                            meta.get("author"),
+                            len(text),
+                            meta.get("og:description") or meta.get("description") or text[:200],
+                            meta.get("og:site_name"),
+                            self.language)
+
+
+def extract_page(data: bytes, content_type: str, charset: str) -> ReaderResult:
+    """
+    Decodes a downloaded page and extracts its text. Runs in a worker process.
+    """
+    try:
+        text = data.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        text = data.decode("utf-8", errors="replace")
+
+    if content_type == "text/plain":
+        return ReaderResult("text", text, None, None, len(text), text[:200], None, None)
+    parser = ArticleParser()
+    parser.feed(text)
+    return parser.result()
+
+
+def is_public_address(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address.split("%", 1)[0])
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    # not loopback, private, link-local (169.254.169.254), multicast or reserved
+    return ip.is_global
+
+
+def check_url(url: str):
+    """
+    Refuses urls the bot must not fetch for a user: other schemes and non public ip addresses.
+    Host names are checked when they are resolved, by PublicResolver.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise Exception("Unsupported url: " + url)
+    try:
+        ipaddress.ip_address(parts.hostname)
+    except ValueError:
+        return
+    if not is_public_address(parts.hostname):
+        raise Exception("Refusing to fetch a non public address: " + url)
+
+
+class PublicResolver():
+    """
+    Resolves host names with the wrapped aiohttp resolver and fails if any address isn't public.
+    The check is made for the connection itself, so the name can't resolve differently between check and connect.
+    """
 
-    payload = 'url='+url
-    headers = { 'Content-Type': 'application/x-www-form-urlencoded' }
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET):
+        hosts = await self.resolver.resolve(host, port, family)
+        for entry in hosts:
+            if not is_public_address(entry["host"]):
+                # aiohttp reports an OSError as a connection error
+                raise OSError(f"{host} resolves to the non public address {entry['host']}")
+        return hosts
+
+    async def close(self):
+        await self.resolver.close()
+
+
+url_cache = TTLCache(FETCH_CACHE_SIZE, FETCH_CACHE_TTL)
+_inflight: Dict[str, asyncio.Future] = {}
+_session = None
+_page_session = None
+_parse_executor = None
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalizes an url so the same page pasted in slightly different ways hits the same cache entry.
+    """
+    if "://" not in url:
+        url = "http://" + url
+
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rsplit(":", 1)[-1]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rsplit(":", 1)[0]
+
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+def _get_session():
+    global _session
+    if _session is None or _session.closed:
+        import aiohttp
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=FETCH_CONNECTIONS, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+        )
+    return _session
+
+
+def _get_page_session():
+    # the pages users link to get a session of their own, the reader service may well be on a private address
+    global _page_session
+    if _page_session is None or _page_session.closed:
+        import aiohttp
+        _page_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=FETCH_CONNECTIONS, ttl_dns_cache=300,
+                                           resolver=PublicResolver(aiohttp.DefaultResolver())),
+            timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+        )
+    return _page_session
+
+
+async def close_session():
+    for session in (_session, _page_session):
+        if session is not None and not session.closed:
+            await session.close()
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False)
+
+
+async def _fetch_remote(url: str) -> ReaderResult:
+    with STAGE_SECONDS.time("fetch_url"):
+        async with _get_session().post(READER_URL, data={"url": url}) as response:
+            if response.status != 200:
+                raise Exception("Error fetching url: "+str(response.status))
+            data = await response.json()
 
-    response = requests.request("POST", "https://reader-mauve-three.vercel.app/api/extract", headers=headers, data=payload)
-    if response.status_code != 200:
-        raise Exception("Error fetching url: "+str(response.status_code))
-    
-    data = response.json()
     return ReaderResult(data['kind'], data['textContent'], data['title'], data['byline'], data['length'], data['excerpt'], data['siteName'], data['language'])
-    
+
+
+async def _download(url: str):
+    """
+    Downloads at most MAX_PAGE_BYTES of the page. Redirects are followed here, so every hop is checked.
+    :return: a tuple (data, content type, charset).
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        check_url(url)
+        async with _get_page_session().get(url, headers={"Accept": "text/html,text/plain"},
+                                           allow_redirects=False) as response:
+            if response.status in REDIRECTS and "Location" in response.headers:
+                url = urljoin(str(response.url), response.headers["Location"])
+                continue
+            if response.status != 200:
+                raise Exception("Error fetching url: "+str(response.status))
+            if response.content_type not in ("text/html", "application/xhtml+xml", "text/plain"):
+                raise Exception("Unsupported content type: "+response.content_type)
+
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(READ_CHUNK_BYTES):
+                data += chunk
+                if len(data) >= MAX_PAGE_BYTES:
+                    break
+            return bytes(data[:MAX_PAGE_BYTES]), response.content_type, response.charset
+    raise Exception("Too many redirects: " + url)
+
+
+async def _fetch_local(url: str) -> ReaderResult:
+    """
+    Downloads the page and extracts its text in a worker process, so a big page doesn't hold up the other chats.
+    """
+    global _parse_executor
+    if "://" not in url:
+        url = "http://" + url
+
+    with STAGE_SECONDS.time("fetch_url"):
+        data, content_type, charset = await _download(url)
+
+    if _parse_executor is None:
+        _parse_executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    with STAGE_SECONDS.time("parse_page"):
+        return await asyncio.get_running_loop().run_in_executor(_parse_executor, extract_page, data, content_type,
+                                                                charset)
+
+
+async def _fetch(url: str) -> ReaderResult:
+    if READER_BACKEND == "local":
+        return await _fetch_local(url)
+    return await _fetch_remote(url)
+
+
+async def fetch_url(url:str)->ReaderResult:
+    """
+    Fetches the readable content of the url.
+    Results are cached and concurrent requests for the same url share a single fetch.
+    """
+    key = normalize_url(url)
+    result = url_cache.get(key)
+    if result is not None:
+        return result
+
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_fetch(url))
+        future.add_done_callback(lambda f: _fetched(key, f))
+        _inflight[key] = future
+
+    return await asyncio.shield(future)
+
+
+def _fetched(key: str, future: asyncio.Future):
+    _inflight.pop(key, None)
+    if not future.cancelled() and future.exception() is None:
+        url_cache.put(key, future.result())
+
+
+async def fetch_urls(urls) -> Dict[str, Union[ReaderResult, Exception]]:
+    """
+    Fetches all the urls concurrently.
+    :return: a dictionary mapping every url to its ReaderResult or to the exception raised while fetching it.
+    """
+    urls = list(urls)
+    results = await asyncio.gather(*(fetch_url(url) for url in urls), return_exceptions=True)
+    return dict(zip(urls, results))
@@ -0,0 +1,108 @@
+import logging
+from functools import lru_cache
+
+from text_utils import estimate_tokens
+
+# context window of the chat models, the longest matching prefix wins
+MODEL_CONTEXT = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-35-turbo": 4096,
+    "gpt-35-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+DEFAULT_CONTEXT = 4096
+BIG_CONTEXT_MODEL = "gpt-3.5-turbo-16k"
+
+# room left for the answer when the prompt is budgeted
+COMPLETION_RESERVE = 700
+
+# every message is wrapped into <|start|>{role}\n{content}<|end|>\n
+TOKENS_PER_MESSAGE = 4
+# every reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_REPLY = 3
+
+
+_encoding_failed = False
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    """
+    :return: the tiktoken encoding of the model, or None to fall back to the estimate.
+    The result is cached, also None, so a failed download of the BPE file isn't retried for every message.
+    """
+    global _encoding_failed
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(model or "")
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads the BPE file on first use, an offline host can't
+        if not _encoding_failed:
+            logging.warning(f"No tiktoken encoding ({e}), token counts are estimated")
+            _encoding_failed = True
+        return None
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    """
+    Counts the tokens of a text with the tokenizer of the model.
+    Falls back to a character based estimate when tiktoken is not installed.
+    """
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate(text: str, max_tokens: int, model: str = None) -> str:
+    """
+    Cuts the text to at most max_tokens tokens, an ellipsis marks the cut.
+    """
+    # a token is rarely longer than 8 characters, don't encode more than can be kept
+    text_prefix = text[:max_tokens * 8]
+    encoding = _encoding(model)
+    if encoding is None:
+        limit = max_tokens * 4
+        return text if len(text) <= limit else text[:limit] + u"\u2026"
+
+    tokens = encoding.encode(text_prefix, disallowed_special=())
+    if len(tokens) <= max_tokens and len(text_prefix) == len(text):
+        return text
+    return encoding.decode(tokens[:max_tokens]) + u"\u2026"
+
+
+def message_tokens(message, model: str = None) -> int:
+    """
+    Returns the number of tokens a history entry takes in the prompt.
+    The count is cached on entries that support it (see ChatMessage),
+    all chat models share the same encoding so the cache is not keyed by model.
+    """
+    tokens = getattr(message, "tokens", None)
+    if tokens is None:
+        tokens = TOKENS_PER_MESSAGE + count_tokens(message["content"] or "", model)
+        if hasattr(message, "tokens"):
+            message.tokens = tokens
+    return tokens
+
+
+def prompt_tokens(messages, model: str = None) -> int:
+    return sum(message_tokens(m, model) for m in messages) + TOKENS_PER_REPLY
+
+
+def context_limit(model: str) -> int:
+    if not model:
+        return DEFAULT_CONTEXT
+
+    prefixes = [name for name in MODEL_CONTEXT if model.startswith(name)]
+    if not prefixes:
+        return DEFAULT_CONTEXT
+    return MODEL_CONTEXT[max(prefixes, key=len)]
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Usage ledger
+#
+# Tokens, voice seconds and synthesized characters are added up per user and per chat, per day and per month,
+# per model and over all models ("*"). Spend is written behind to SQLite in batches by a worker thread, on a
+# timer or once enough rollups are waiting, so the event loop never waits for a commit. The store is shared by
+# all the processes of the bot (e.g. the webhook workers), so quotas hold across them. A total is the stored
+# value plus the spend of this process not written yet; stored values are cached until the next flush, so a
+# quota check is a few dictionary lookups and other processes' spend shows up within FLUSH_SECONDS.
+# Quotas are checked with the locally estimated prompt before a request is sent; 0 disables a quota.
+
+USAGE_STORE = os.getenv("USAGE_STORE", "usage.sqlite3")
+USER_DAILY_TOKENS = int(os.getenv("USER_DAILY_TOKENS", 200000))
+USER_MONTHLY_TOKENS = int(os.getenv("USER_MONTHLY_TOKENS", 2000000))
+CHAT_DAILY_TOKENS = int(os.getenv("CHAT_DAILY_TOKENS", 500000))
+USER_DAILY_VOICE_SECONDS = int(os.getenv("USER_DAILY_VOICE_SECONDS", 3600))
+# dirty rollups are written after this many seconds or updates
+FLUSH_SECONDS = 5
+FLUSH_UPDATES = 500
+# seconds to wait for another process writing the store
+STORE_TIMEOUT = 10
+
+ALL_MODELS = "*"
+# columns of a rollup
+PROMPT_TOKENS, COMPLETION_TOKENS, VOICE_SECONDS, REQUESTS, SPEECH_CHARACTERS = range(5)
+COLUMNS = ("prompt_tokens", "completion_tokens", "voice_seconds", "requests", "speech_characters")
+
+
+def periods(now: float = None):
+    """
+    :return: the keys of the current day and month, e.g. ("2023-05-17", "2023-05").
+    """
+    day = time.strftime("%Y-%m-%d", time.gmtime(now))
+    return day, day[:7]
+
+
+class UsageLedger():
+    """
+    Time bucketed usage rollups per user, chat and model.
+    """
+
+    def __init__(self, path: str = USAGE_STORE):
+        self.db = sqlite3.connect(path, timeout=STORE_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS usage (scope TEXT NOT NULL, id INTEGER NOT NULL, "
+                        "period TEXT NOT NULL, model TEXT NOT NULL, prompt_tokens INTEGER NOT NULL, "
+                        "completion_tokens INTEGER NOT NULL, voice_seconds REAL NOT NULL, requests INTEGER NOT NULL, "
+                        "speech_characters INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (scope, id, period, model))")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(usage)")]
+        if "speech_characters" not in columns:
+            self.db.execute("ALTER TABLE usage ADD COLUMN speech_characters INTEGER NOT NULL DEFAULT 0")
+        self.db.commit()
+        # the flushes write through a connection of their own, in WAL mode the reads don't wait for them
+        self.writer = sqlite3.connect(path, timeout=STORE_TIMEOUT, check_same_thread=False)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usage")
+
+        self.periods = periods()
+        self.stored = {}    # (scope, id, period, model) -> the stored rollup, until the next flush
+        self.dirty = {}     # the same keys -> the amounts not written yet
+        self.writing = {}   # the same keys -> the amounts being written
+        self.flush_now = None
+        self.flusher = None
+
+    def _rollup(self, key) -> list:
+        stored = self.stored.get(key)
+        if stored is None:
+            row = self.db.execute(f"SELECT {', '.join(COLUMNS)} FROM usage "
+                                  "WHERE scope = ? AND id = ? AND period = ? AND model = ?", key).fetchone()
+            stored = self.stored[key] = list(row) if row is not None else [0, 0, 0.0, 0, 0]
+        rollup = list(stored)
+        for pending in (self.writing.get(key), self.dirty.get(key)):
+            if pending is not None:
+                rollup = [value + amount for value, amount in zip(rollup, pending)]
+        return rollup
+
+    def _roll_over(self):
+        # the rollups are keyed by the period, the ones of the previous period are flushed as usual
+        self.periods = periods()
+
+    def usage(self, scope: str, id: int, period: str = "day", model: str = ALL_MODELS) -> list:
+        """
+        :param scope: "user" or "chat".
+        :param period: "day" or "month", the current one.
+        :return: [prompt tokens, completion tokens, voice seconds, requests, speech characters].
+        """
+        self._roll_over()
+        return self._rollup((scope, id, self.periods[0] if period == "day" else self.periods[1], model))
+
+    def tokens(self, scope: str, id: int, period: str = "day", model: str = ALL_MODELS) -> int:
+        rollup = self.usage(scope, id, period, model)
+        return rollup[PROMPT_TOKENS] + rollup[COMPLETION_TOKENS]
+
+    def record(self, user_id: int, chat_id: int, model: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+               voice_seconds: float = 0, speech_characters: int = 0):
+        self._roll_over()
+        amounts = (prompt_tokens, completion_tokens, voice_seconds, 1, speech_characters)
+        for scope, id in (("user", user_id), ("chat", chat_id)):
+            for period in self.periods:
+                for name in (model, ALL_MODELS):
+                    dirty = self.dirty.setdefault((scope, id, period, name), [0, 0, 0.0, 0, 0])
+                    for column, amount in enumerate(amounts):
+                        dirty[column] += amount
+
+        if len(self.dirty) >= FLUSH_UPDATES and self.flush_now is not None:
+            self.flush_now.set()
+
+    def check(self, user_id: int, chat_id: int, tokens: int = 0, voice_seconds: float = 0):
+        """
+        Checks the quotas before a request.
+        :param tokens: the estimated tokens of the request.
+        :param voice_seconds: the length of the audio to transcribe.
+        :return: None if the request is allowed, otherwise the reason it is not.
+        """
+        if USER_DAILY_TOKENS and tokens and self.tokens("user", user_id, "day") + tokens > USER_DAILY_TOKENS:
+            return f"Your daily limit of {USER_DAILY_TOKENS} tokens is reached, please try again tomorrow."
+        if USER_MONTHLY_TOKENS and tokens and self.tokens("user", user_id, "month") + tokens > USER_MONTHLY_TOKENS:
+            return f"Your monthly limit of {USER_MONTHLY_TOKENS} tokens is reached."
+        if CHAT_DAILY_TOKENS and tokens and self.tokens("chat", chat_id, "day") + tokens > CHAT_DAILY_TOKENS:
+            return f"The daily limit of {CHAT_DAILY_TOKENS} tokens of this chat is reached, please try again tomorrow."
+        if USER_DAILY_VOICE_SECONDS and voice_seconds and \
+                self.usage("user", user_id, "day")[VOICE_SECONDS] + voice_seconds > USER_DAILY_VOICE_SECONDS:
+            return f"Your daily limit of {USER_DAILY_VOICE_SECONDS} seconds of voice is reached, please try again tomorrow."
+        return None
+
+    def _write(self, rows: list):
+        self.writer.executemany(
+            f"INSERT INTO usage (scope, id, period, model, {', '.join(COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (scope, id, period, model) DO UPDATE SET " +
+            ", ".join(f"{column} = {column} + excluded.{column}" for column in COLUMNS),
+            rows)
+        self.writer.commit()
+
+    async def flush(self):
+        """
+        Writes the spend of this process and forgets the cached stored values, the next reads see the other
+        processes' spend too.
+        """
+        if self.writing:
+            # a flush is running
+            return
+        if self.dirty:
+            self.writing, self.dirty = self.dirty, {}
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self._write, [key + tuple(amounts) for key, amounts in self.writing.items()])
+            except asyncio.CancelledError:
+                # the worker thread finishes the write
+                raise
+            except Exception:
+                # written by the next flush
+                for key, amounts in self.writing.items():
+                    dirty = self.dirty.setdefault(key, [0, 0, 0.0, 0, 0])
+                    for column, amount in enumerate(amounts):
+                        dirty[column] += amount
+                raise
+            finally:
+                count, self.writing = len(self.writing), {}
+                self.stored = {}
+            logging.debug(f"Flushed {count} usage rollups")
+        self.stored = {}
+
+    async def _flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_now.wait(), FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_now.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Flushing the usage failed: {e}")
+
+    def start(self):
+        """
+        Starts writing the spend every FLUSH_SECONDS, and as soon as FLUSH_UPDATES rollups are waiting.
+        """
+        if self.flusher is None:
+            self.flush_now = asyncio.Event()
+            self.flusher = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+        await self.flush()
+        self.executor.shutdown()
+        self.writer.close()
+        self.db.close()
@@ -1,5 +1,11 @@
 import time
-from collections import defaultdict
+
+from tokens import message_tokens, prompt_tokens
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+PASSAGES_PREFIX = "Passages of the documents the user shared, use them to answer:\n\n"
+# evicted messages waiting for the summarizer, the oldest are dropped if it can't keep up
+MAX_EVICTED = 50
 
 # UserChatThread Class
 
@@ -10,6 +16,11 @@ from collections import defaultdict
 # - history: a list of dictionaries where every dictionary represents a message sent in the conversation. The dictionary has two attributes; role and content.
 # - last_message_time: a float value that represents the timestamp of the last message sent in the conversation.
 # - history_trim: an integer variable to limit the length of the chat thread history.
+# - summary: a system message with the running summary of the messages that dropped out of history, or None.
+# - evicted: the messages that dropped out of history and are not folded into the summary yet.
+# - passages: a system message with the document passages retrieved for the last question, or None. Not saved.
+# - streaming: a boolean value, when set the answer is streamed into the chat while it is generated.
+# - voice_replies: a boolean value, when set the answer is also sent as voice messages.
 # - completion_tokens: an integer value representing the number of completion tokens used in the conversation.
 # - prompt_tokens: an integer value representing the number of prompt tokens used in the conversation.
 # - total_tokens: an integer value representing the total number of tokens used in the conversation.
@@ -21,7 +32,25 @@ from collections import defaultdict
 # - session_voice_messages: an integer value representing the number of voice messages sent in the current conversation session.
 # - session_duration_seconds: a float value representing the total duration of voice messages sent in the current conversation session.
 
+class ChatMessage(dict):
+    """
+    A history entry. It is a plain dict so it can be sent to the API as is,
+    the token count of the message is cached next to it.
+    """
+    __slots__ = ("tokens",)
+
+    def __init__(self, role: str, content: str):
+        super().__init__(role=role, content=content)
+        self.tokens = None
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.tokens = None
+
+
 class ModelStats():
+    __slots__ = ("completion_tokens", "prompt_tokens", "total_tokens", "sessions", "messages", "errors")
+
     def __init__(self):
         self.completion_tokens = 0
         self.prompt_tokens = 0
@@ -35,29 +64,58 @@ class ModelStats():
         f"Prompt tokens: {self.prompt_tokens} ({self.prompt_tokens / self.total_tokens * 100:.1f}%)\n"
         f"Completion tokens: {self.completion_tokens} ({self.completion_tokens / self.total_tokens * 100:.1f}%)\n"
         f"Total tokens used: {self.total_tokens}\n")
-        
+
+    def to_list(self) -> list:
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_list(cls, values: list):
+        stats = cls()
+        for name, value in zip(cls.__slots__, values):
+            setattr(stats, name, value)
+        return stats
+
+
 class UserChatThread():
+    __slots__ = ("system", "history", "summary", "evicted", "passages", "last_message_time", "history_trim", "suggestions", "streaming", "voice_replies",
+                 "models", "sessions", "voice_messages", "duration_seconds",
+                 "session_messages", "session_voice_messages", "session_duration_seconds", "changed")
+    # not saved, assigning them doesn't make the thread changed
+    TRANSIENT = ("passages", "changed")
+
     def __init__(self):
-        print("UserChatThread init")
-        self.system = {"role": "system", "content": "Use metric units"}
+        self.system = ChatMessage("system", "Use metric units")
         self.history = [self.system]
+        self.summary = None
+        self.evicted = []
+        self.passages = None
         self.last_message_time = 0
         self.history_trim = 10
         self.suggestions = 0
+        self.streaming = True
+        self.voice_replies = False
 
-        self.models = defaultdict(ModelStats)
+        self.models = {}
         self.sessions = 1
         self.voice_messages = 0
         self.duration_seconds = 0
         self.session_messages = 0
         self.session_voice_messages = 0
         self.session_duration_seconds = 0
+        # set by every change, the store saves and clears it
+        self.changed = False
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name not in UserChatThread.TRANSIENT:
+            object.__setattr__(self, "changed", True)
 
     def append(self, role:str, content:str):
         """
         Appends a message to the conversation history.
         If the length of history attribute exceeds history_trim, it removes the first element of the list.
         Also, it sets the last_message_time attribute to the current time.
+        Removed messages are kept in evicted until they are folded into the summary.
 
         :param role: a string value representing the role of the message sender.
         :param content: a string value representing the content of the message.
@@ -65,29 +123,110 @@ class UserChatThread():
         """
 
         if time.time() - self.last_message_time > 60 * 10: # 10 minutes
-            self.history = [self.system]
+            self.evict(1, len(self.history))
 
-        self.history.append({"role": role, "content": content})
+        self.history.append(ChatMessage(role, content))
         self.last_message_time = time.time()
         if len(self.history) > self.history_trim:
-            self.history.pop(1)
+            self.evict(1, 2)
+
+    def fold_passive(self, passive:list):
+        """
+        Appends the group messages the bot didn't answer to the history as a single message.
+        :param passive: a list of (author, text), see ConversationStore.take_passive.
+        """
+        if not passive:
+            return
+        lines = "\n".join(f"{author}: {text}" for author, text in passive)
+        self.append("user", "Messages in the chat since the last answer:\n" + lines)
+
+    def evict(self, start:int, end:int):
+        """
+        Moves history[start:end] to the messages waiting to be summarized.
+        """
+        self.evicted.extend(self.history[start:end])
+        del self.history[start:end]
+        if len(self.evicted) > MAX_EVICTED:
+            del self.evicted[:len(self.evicted) - MAX_EVICTED]
+        self.changed = True
+
+    def prompt(self) -> list:
+        """
+        Returns the messages sent to the API: the system message, the summary of the older messages,
+        the retrieved document passages and the history.
+        """
+        context = [message for message in (self.summary, self.passages) if message is not None]
+        if not context:
+            return self.history
+        return [self.system] + context + self.history[1:]
 
-    def prune(self, current_tokens:int, max_tokens:int)->bool:
+    def set_system(self, content:str):
+        """
+        Replaces the system message (the role of the bot).
+        """
+        self.system["content"] = content
+        self.changed = True
+
+    def set_passages(self, passages:list):
+        """
+        Sets the document passages sent with the next prompts.
+        :param passages: a list of passage texts, an empty list removes them.
+        """
+        self.passages = ChatMessage("system", PASSAGES_PREFIX + "\n\n".join(passages)) if passages else None
+
+    def fold_summary(self, summary:str, folded:list)->bool:
+        """
+        Replaces the summary with one that covers the folded messages too and forgets them.
+        :param summary: the new summary text.
+        :param folded: the evicted messages the summary was generated from.
+        :return: False if the evicted messages changed meanwhile (e.g. the conversation was reset) and the summary is dropped.
+        """
+        if len(self.evicted) < len(folded) or self.evicted[:len(folded)] != folded:
+            return False
+        del self.evicted[:len(folded)]
+        self.summary = ChatMessage("system", SUMMARY_PREFIX + summary)
+        return True
+
+    def summary_text(self) -> str:
+        return self.summary["content"][len(SUMMARY_PREFIX):] if self.summary is not None else ""
+
+    def count_tokens(self, model:str=None)->int:
+        """
+        Counts the prompt tokens of the conversation, using the cached per message counts.
+        :param model: the model the prompt is sent to.
+        """
+        return prompt_tokens(self.prompt(), model)
+
+    def prune(self, current_tokens:int, max_tokens:int, model:str=None)->bool:
         """
         Prunes the conversation history to fit the maximum number of tokens allowed.
+        Drops the oldest messages in a single pass, the system message and the last message are always kept.
         :param current_tokens: an integer value representing the current number of tokens used in the conversation.
         :param max_tokens: an integer value representing the maximum number of tokens allowed in the conversation.
+        :return: True if the history fits into max_tokens after pruning.
         """
-        if len(self.history) < 2:
+        if current_tokens <= max_tokens:
+            return True
+
+        cut = 1
+        while cut < len(self.history) - 1 and current_tokens > max_tokens:
+            current_tokens -= message_tokens(self.history[cut], model)
+            cut += 1
+
+        if cut == 1:
             return False
-        self.history.pop(1)
-        return True
+
+        self.evict(1, cut)
+        return current_tokens <= max_tokens
 
     def reset(self):
         """
         Resets the session and statistics.
         """
         self.history = [self.system]
+        self.summary = None
+        self.evicted = []
+        self.passages = None
         self.last_message_time = 0
         self.sessions += 1
         self.session_messages = 0
@@ -109,7 +248,7 @@ class UserChatThread():
         Increases the usage statistics.
         :param usage: a dictionary object representing the usage statistics.
         """
-        model_stats : ModelStats = self.models[model]
+        model_stats : ModelStats = self.model_stats(model)
         model_stats.prompt_tokens += usage["prompt_tokens"]
         model_stats.completion_tokens += usage["completion_tokens"]
         model_stats.total_tokens += usage["total_tokens"]
@@ -117,5 +256,51 @@ class UserChatThread():
         self.session_messages += 1
 
     def increase_error(self, model:str):
-        self.models[model].errors += 1
+        self.model_stats(model).errors += 1
+        self.changed = True
+
+    def model_stats(self, model:str) -> ModelStats:
+        stats = self.models.get(model)
+        if stats is None:
+            stats = self.models[model] = ModelStats()
+        return stats
+
+    def to_dict(self) -> dict:
+        """
+        Returns a compact, JSON serializable representation of the thread.
+        """
+        return {
+            "system": self.system["content"],
+            "history": [[m["role"], m["content"]] for m in self.history[1:]],
+            "summary": self.summary_text(),
+            "evicted": [[m["role"], m["content"]] for m in self.evicted],
+            "last_message_time": self.last_message_time,
+            "suggestions": self.suggestions,
+            "streaming": self.streaming,
+            "voice_replies": self.voice_replies,
+            "models": {name: stats.to_list() for name, stats in self.models.items()},
+            "stats": [self.sessions, self.voice_messages, self.duration_seconds, self.session_messages,
+                      self.session_voice_messages, self.session_duration_seconds],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """
+        Restores a thread saved with to_dict.
+        """
+        thread = cls()
+        thread.system["content"] = data["system"]
+        thread.history = [thread.system] + [ChatMessage(role, content) for role, content in data["history"]]
+        if data.get("summary"):
+            thread.summary = ChatMessage("system", SUMMARY_PREFIX + data["summary"])
+        thread.evicted = [ChatMessage(role, content) for role, content in data.get("evicted", ())]
+        thread.last_message_time = data["last_message_time"]
+        thread.suggestions = data["suggestions"]
+        thread.streaming = data["streaming"]
+        thread.voice_replies = data.get("voice_replies", False)
+        thread.models = {name: ModelStats.from_list(values) for name, values in data["models"].items()}
+        (thread.sessions, thread.voice_messages, thread.duration_seconds, thread.session_messages,
+         thread.session_voice_messages, thread.session_duration_seconds) = data["stats"]
+        thread.changed = False
+        return thread
         
@@ -0,0 +1,233 @@
+import asyncio
+import io
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import openai
+from aiogram import types
+
+from metrics import STAGE_SECONDS
+from backends import pool
+from openai_scheduler import TRANSCRIPTION
+
+VOICE_MODEL = "whisper-1"
+VOICE_WORKERS = int(os.getenv("VOICE_WORKERS", os.cpu_count() or 1))
+# the transcription API accepts telegram's OGG/Opus as is, the re-encode is only needed to split long recordings
+VOICE_DIRECT_OGG = os.getenv("VOICE_DIRECT_OGG", "1") == "1"
+MAX_VOICE_MS = 60 * 60 * 1000  # 1 hour PyDub handles time in milliseconds
+# long recordings are split into chunks of about this length and transcribed concurrently
+VOICE_CHUNK_MS = int(os.getenv("VOICE_CHUNK_MS", 2 * 60 * 1000))
+VOICE_OVERLAP_MS = 1500
+VOICE_PARALLELISM = int(os.getenv("VOICE_PARALLELISM", 4))
+# how far back from the target length a chunk may be cut at a silence
+SILENCE_SEARCH_MS = 20 * 1000
+SILENCE_MIN_MS = 400
+# number of words compared when the overlapping transcripts are stitched
+STITCH_WORDS = 30
+
+
+def plan_chunks(data: bytes, max_ms: int = MAX_VOICE_MS, chunk_ms: int = VOICE_CHUNK_MS):
+    """
+    Decodes an OGG voice message and picks where to cut it: in the middle of the latest silence
+    before every `chunk_ms`. Only the SILENCE_SEARCH_MS before a cut are searched for silence.
+    Runs in a worker process, so it only takes and returns picklable values.
+
+    :return: a tuple (list of (start, end) of the chunks in ms, duration of the original audio in seconds).
+    """
+    from pydub import AudioSegment
+    from pydub.silence import detect_silence
+    song = AudioSegment.from_file(io.BytesIO(data), format="ogg")
+    duration_seconds = song.duration_seconds
+    song = song[:max_ms]
+
+    cuts = []
+    start = 0
+    threshold = song.dBFS - 16
+    while len(song) - start > chunk_ms:
+        target = start + chunk_ms
+        window = max(start + 1, target - SILENCE_SEARCH_MS)
+        silences = detect_silence(song[window:target], min_silence_len=SILENCE_MIN_MS, silence_thresh=threshold,
+                                  seek_step=10)
+        cut = window + (silences[-1][0] + silences[-1][1]) // 2 if silences else target
+        cuts.append(cut)
+        start = cut
+    return list(zip([0] + cuts, cuts + [len(song)])), duration_seconds
+
+
+def encode_chunk(data: bytes, start: int, end: int, overlap_ms: int = VOICE_OVERLAP_MS, format: str = "mp3") -> bytes:
+    """
+    Decodes the part of an OGG voice message from `start - overlap_ms` to `end` and encodes it to `format`.
+    Runs in a worker process, every chunk is a job of its own.
+    """
+    from pydub import AudioSegment
+    start = max(start - overlap_ms, 0)
+    chunk = AudioSegment.from_file(io.BytesIO(data), format="ogg", start_second=start / 1000,
+                                   duration=(end - start) / 1000)
+    out = io.BytesIO()
+    chunk.export(out, format=format)
+    return out.getvalue()
+
+
+def _words(text: str):
+    return [word.strip(".,!?;:\"'()").lower() for word in text.split()]
+
+
+def stitch(parts) -> str:
+    """
+    Joins the transcripts of overlapping chunks, dropping the words the overlap transcribed twice.
+    """
+    text = ""
+    for part in parts:
+        part = part.strip()
+        if not text:
+            text = part
+            continue
+
+        tail = _words(text)[-STITCH_WORDS:]
+        head = _words(part)[:STITCH_WORDS]
+
+        overlap = 0
+        for size in range(min(len(tail), len(head)), 0, -1):
+            if tail[-size:] == head[:size]:
+                overlap = size
+                break
+        text += " " + " ".join(part.split()[overlap:])
+    return text.strip()
+
+
+async def atranscribe(chunk: bytes, name: str, prompt: str = None, model: str = VOICE_MODEL, engine: str = None,
+                      **kwargs):
+    # a fresh buffer for every attempt, a retry has to read the audio from the start
+    audio = io.BytesIO(chunk)
+    audio.name = name
+    if engine is not None:
+        # the azure deployment, chosen by the backend pool
+        kwargs["deployment_id"] = engine
+    return await openai.Audio.atranscribe(model, audio, prompt=prompt, **kwargs)
+
+
+class StageTiming():
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def str(self):
+        return f"{self.count} runs, avg {self.total / max(self.count, 1):.2f}s, max {self.max:.2f}s"
+
+
+class VoicePipeline():
+    """
+    Turns telegram voice messages into text without blocking the event loop.
+    Audio is downloaded into memory, decoding/encoding runs in a bounded process pool
+    and the transcription API is called asynchronously, at most `parallelism` requests at a time.
+    """
+
+    def __init__(self, workers: int = VOICE_WORKERS, direct_ogg: bool = VOICE_DIRECT_OGG,
+                 parallelism: int = VOICE_PARALLELISM):
+        self.workers = workers
+        self.direct_ogg = direct_ogg
+        self.parallelism = parallelism
+        self.executor = None
+        self.slots = None
+        self._parallel = None
+        self.queued = 0
+        self.running = 0
+        self.timings = defaultdict(StageTiming)
+
+    @property
+    def parallel(self) -> asyncio.Semaphore:
+        # created lazily, so it binds to the running loop
+        if self._parallel is None:
+            self._parallel = asyncio.Semaphore(self.parallelism)
+        return self._parallel
+
+    async def _stage(self, name: str, awaitable):
+        start = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            elapsed = time.monotonic() - start
+            self.timings[name].add(elapsed)
+            STAGE_SECONDS.observe(elapsed, "voice_" + name)
+
+    async def _transcode(self, fn, *args):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            self.slots = asyncio.Semaphore(self.workers)
+
+        self.queued += 1
+        waiting = True
+        try:
+            async with self.slots:
+                self.queued -= 1
+                waiting = False
+                self.running += 1
+                try:
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(self.executor, fn, *args)
+                finally:
+                    self.running -= 1
+        finally:
+            if waiting:
+                self.queued -= 1
+
+    async def _transcribe_chunk(self, chunk: bytes, name: str, prompt: str = None) -> str:
+        transcript = await self._stage("transcribe", pool.call(atranscribe, chunk, name, prompt,
+                                                               model=VOICE_MODEL, priority=TRANSCRIPTION))
+        return transcript["text"]
+
+    async def transcribe(self, voice: types.Voice, prompt: str = None):
+        """
+        Downloads and transcribes a voice message.
+        Long recordings are split into overlapping chunks that are transcribed concurrently and stitched back.
+        Every chunk is encoded by a job of its own and transcribed as soon as it is encoded.
+
+        :param voice: the telegram voice message.
+        :param prompt: text to guide the transcription, e.g. the previous message of the conversation.
+        :return: a tuple (transcript text, duration of the voice message in seconds).
+        """
+        buffer = io.BytesIO()
+        await self._stage("download", voice.download(destination_file=buffer))
+        data = buffer.getvalue()
+
+        duration = voice.duration
+        if self.direct_ogg and duration * 1000 <= VOICE_CHUNK_MS:
+            async with self.parallel:
+                text = await self._transcribe_chunk(data, "voice.ogg", prompt)
+            return text, duration
+
+        chunks, duration = await self._stage("plan", self._transcode(plan_chunks, data))
+        logging.debug(f"Transcribing {len(chunks)} chunks, {duration} sec")
+
+        texts = [None] * len(chunks)
+
+        async def transcribe_chunk(index: int):
+            start, end = chunks[index]
+            chunk = await self._stage("transcode", self._transcode(encode_chunk, data, start, end))
+            async with self.parallel:
+                # the previous chunk's text guides the transcription when it is already known,
+                # waiting for it would serialize the chunks
+                previous = texts[index - 1] if index > 0 else None
+                texts[index] = await self._transcribe_chunk(chunk, f"voice{index}.mp3", previous or prompt)
+
+        await asyncio.gather(*(transcribe_chunk(index) for index in range(len(chunks))))
+        return stitch(texts), duration
+
+    def str(self):
+        stages = "\n".join(f" {name}: {timing.str()}" for name, timing in self.timings.items())
+        return f"Queued: {self.queued}, transcoding: {self.running}/{self.workers}\n{stages}\n"
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
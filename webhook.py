@@ -0,0 +1,234 @@
+import logging
+
+# configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s')
+
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+
+from aiohttp import web, ClientSession, ClientTimeout
+
+# Webhook entry point
+#
+# The front process receives the updates from Telegram and forwards every update to the worker that owns
+# its chat. Workers are picked by a consistent hash of the chat id, so a conversation is only ever touched
+# by one process and adding a worker only moves a small share of the chats.
+# Workers are spawned locally (WEBHOOK_PROCESSES) or given as urls of workers on other machines (WEBHOOK_WORKERS).
+#
+#   python webhook.py           runs the front and the local workers
+#   python webhook.py worker    runs a single worker, listening on WORKER_PORT
+#
+# The rate limits are kept per process. Local workers each get 1/WEBHOOK_PROCESSES of them (LIMIT_SHARE),
+# workers on other machines need LIMIT_SHARE set by hand. THROTTLE_BACKEND=redis shares the Telegram
+# buckets between all of them instead.
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public url Telegram posts the updates to
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_PROCESSES = int(os.getenv("WEBHOOK_PROCESSES", os.cpu_count() or 1))
+WEBHOOK_WORKERS = [url for url in os.getenv("WEBHOOK_WORKERS", "").split(",") if url]
+WORKER_HOST = os.getenv("WORKER_HOST", "127.0.0.1")
+WORKER_PORT = int(os.getenv("WORKER_PORT", 8100))
+WORKER_PATH = "/update"
+# seconds to finish the updates in flight on shutdown
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 60))
+HASH_REPLICAS = 100
+
+# the objects of an update that carry the chat
+CHAT_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member", "chat_member",
+               "chat_join_request")
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing():
+    """
+    Consistent hash ring, every node is placed on the ring `replicas` times to spread the keys evenly.
+    """
+
+    def __init__(self, nodes, replicas: int = HASH_REPLICAS):
+        ring = sorted((hash_key(f"{node}#{replica}"), node) for node in nodes for replica in range(replicas))
+        self.hashes = [point for point, _ in ring]
+        self.nodes = [node for _, node in ring]
+
+    def node(self, key):
+        index = bisect.bisect(self.hashes, hash_key(str(key))) % len(self.hashes)
+        return self.nodes[index]
+
+
+def update_chat_id(update: dict):
+    """
+    Returns the id of the chat the update belongs to, updates without a chat are keyed by the user.
+    """
+    for field in CHAT_FIELDS:
+        if field in update:
+            return update[field]["chat"]["id"]
+
+    if "callback_query" in update:
+        callback_query = update["callback_query"]
+        if callback_query.get("message"):
+            return callback_query["message"]["chat"]["id"]
+        return callback_query["from"]["id"]
+
+    for value in update.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return update.get("update_id")
+
+
+class Draining():
+    """
+    Tracks the requests in flight, so shutdown can wait for them.
+    """
+
+    def __init__(self):
+        self.tasks = set()
+        self.closing = False
+
+    def track(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT):
+        self.closing = True
+        if self.tasks:
+            logging.info(f"Draining {len(self.tasks)} updates")
+            await asyncio.wait(self.tasks, timeout=timeout)
+
+
+# worker
+
+async def worker_app() -> web.Application:
+    from aiogram import Bot, Dispatcher, types
+    import openaitelegram
+
+    draining = Draining()
+
+    async def handle_update(request: web.Request):
+        if draining.closing:
+            return web.Response(status=503)
+
+        update = types.Update(**(await request.json()))
+        draining.track(openaitelegram.dp.process_update(update))
+        return web.Response()
+
+    async def on_startup(app):
+        Bot.set_current(openaitelegram.bot)
+        Dispatcher.set_current(openaitelegram.dp)
+        await openaitelegram.on_startup(openaitelegram.dp)
+
+    async def on_shutdown(app):
+        await draining.drain()
+        # the scheduled answers and background tasks of the chats, a finished answer may start a summary
+        deadline = asyncio.get_running_loop().time() + DRAIN_TIMEOUT
+        pending = openaitelegram.pending_tasks()
+        while pending and asyncio.get_running_loop().time() < deadline:
+            logging.info(f"Waiting for {len(pending)} answers and background tasks")
+            await asyncio.wait(pending, timeout=deadline - asyncio.get_running_loop().time())
+            pending = openaitelegram.pending_tasks()
+        await openaitelegram.on_shutdown(openaitelegram.dp)
+        await openaitelegram.bot.close()
+
+    app = web.Application()
+    app.router.add_post(WORKER_PATH, handle_update)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def run_worker(port: int = WORKER_PORT, processes: int = 1):
+    # the rate limits hold for the bot as a whole, local workers split them
+    if processes > 1:
+        os.environ.setdefault("LIMIT_SHARE", str(1 / processes))
+    # every local worker serves its own metrics, next to the first worker's port
+    metrics_port = int(os.getenv("METRICS_PORT", 9090))
+    if metrics_port:
+        os.environ["METRICS_PORT"] = str(metrics_port + port - WORKER_PORT)
+    web.run_app(worker_app(), host=WORKER_HOST, port=port, shutdown_timeout=DRAIN_TIMEOUT)
+
+
+# front
+
+async def front_app(workers) -> web.Application:
+    from aiogram import Bot
+    from api_key import bot_token
+
+    ring = HashRing(workers)
+    draining = Draining()
+
+    async def forward(worker: str, update: dict) -> int:
+        async with app["session"].post(worker + WORKER_PATH, json=update) as response:
+            return response.status
+
+    async def handle_update(request: web.Request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        if draining.closing:
+            # Telegram retries the update later
+            return web.Response(status=503)
+
+        update = await request.json()
+        worker = ring.node(update_chat_id(update))
+        try:
+            status = await draining.track(forward(worker, update))
+        except Exception as e:
+            logging.error(f"Forwarding to {worker} failed: {e}")
+            status = 502
+        return web.Response(status=200 if status == 200 else 502)
+
+    async def on_startup(app):
+        app["session"] = ClientSession(timeout=ClientTimeout(total=10))
+        if WEBHOOK_URL:
+            bot = Bot(token=bot_token)
+            await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+            await bot.close()
+
+    async def on_shutdown(app):
+        await draining.drain()
+        await app["session"].close()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def main():
+    processes = []
+    workers = WEBHOOK_WORKERS
+    if not workers:
+        context = multiprocessing.get_context("spawn")
+        for index in range(WEBHOOK_PROCESSES):
+            port = WORKER_PORT + index
+            process = context.Process(target=run_worker, args=(port, WEBHOOK_PROCESSES), name=f"worker-{index}")
+            process.start()
+            processes.append(process)
+            workers.append(f"http://{WORKER_HOST}:{port}")
+
+    try:
+        web.run_app(front_app(workers), host=WEBHOOK_HOST, port=WEBHOOK_PORT, shutdown_timeout=DRAIN_TIMEOUT)
+    finally:
+        # the front stopped accepting updates, let the workers finish theirs
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(DRAIN_TIMEOUT)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if sys.argv[1:] == ["worker"]:
+        run_worker()
+    else:
+        main()